@@ -2,11 +2,13 @@
 
 import os
 import re
+import glob
 import sys
 import csv
 import numpy as np
 import pandas as pd
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
 from scipy import optimize
 from scipy.interpolate import interp1d
 from scipy import constants
@@ -16,6 +18,7 @@ import matplotlib.pyplot as plt
 from ruamel_yaml import YAML
 import pdb
 import pmath
+import results
 
 yaml = YAML()
 
@@ -35,24 +38,66 @@ def get_output_path_from_yaml(yaml_config):
 def get_FTIR_data(spectral_data, data_format=None):
 	"""
 	Retrieve csv spectral data from JASCO FTIR output and store in array.
+	The header and footer are found automatically (see find_FTIR_data) and
+	the numeric block is parsed in one call.
+	Outputs: wavenumbers and intensities as float64 arrays.
 	"""
-
-	wavenumber_list = np.array([])
-	intensity_list = np.array([])
-	with open(spectral_data, 'r', errors='ignore') as spectrum:
-		csvreader = csv.reader(spectrum)
-		num_header_rows = 19   # Yeah this is hard coded. Not so great.
-		for s in range(num_header_rows):
-			next(csvreader, None)
-		for row in csvreader:
-			if row:
-				wavenum = float(row[0])
-				inten = float(row[1])
-				wavenumber_list = np.append(wavenumber_list, wavenum)
-				intensity_list = np.append(intensity_list, inten)
-			else:
-				break
-	return wavenumber_list, intensity_list
+	with open(spectral_data, 'r', encoding='utf8', errors='ignore') as spectrum:
+		lines = spectrum.read().splitlines()
+	start, end = find_FTIR_data(lines)
+	delimiter = ',' if ',' in lines[start] else None
+	try:
+		data = np.loadtxt(lines[start:end], delimiter=delimiter, usecols=(0, 1), ndmin=2)
+	except ValueError:
+		# Jasco sometimes leaves non utf-8 junk partway through the data
+		rows = [line for line in lines[start:end] if is_data_row(line)]
+		data = np.loadtxt(rows, delimiter=delimiter, usecols=(0, 1), ndmin=2)
+	return data[:, 0], data[:, 1]
+
+
+def find_FTIR_data(lines):
+	"""
+	Locate the numeric block of a JASCO FTIR csv file given as a list of lines.
+	The block starts after the 'XYDATA' header line (or, without one, at the
+	first line holding two numbers) and ends at the blank line before the
+	footer, or after NPOINTS rows when the header gives the number of points.
+	Outputs: index of the first data line and one past the last.
+	"""
+	start = None
+	num_points = None
+	for idx, line in enumerate(lines):
+		key = line.split(',')[0].strip().upper()
+		if key == 'NPOINTS':
+			num_points = int(float(line.split(',')[1]))
+		elif key == 'XYDATA':
+			start = idx + 1
+			break
+		elif is_data_row(line):
+			start = idx
+			break
+	if start is None:
+		raise ValueError("No spectral data found")
+
+	try:
+		end = lines.index('', start)
+	except ValueError:
+		end = len(lines)
+	if num_points is not None:
+		end = min(end, start + num_points)
+	while end > start and not is_data_row(lines[end-1]):
+		end -= 1  # Footer lines that are not separated by a blank line
+	return start, end
+
+
+def is_data_row(line):
+	"""True if a line starts with two numbers separated by a comma or whitespace."""
+	fields = line.replace(',', ' ').split()
+	try:
+		float(fields[0])
+		float(fields[1])
+	except (IndexError, ValueError):
+		return False
+	return True
 
 
 def get_tmm_data(datafile):
@@ -77,47 +122,113 @@ def get_tmm_data(datafile):
 	return wavenumber_list, intensity_list
 
 
-def get_angle_data_from_dir(directory, convert_units=None, data_format=None):
+ANGLE_FILE_PATTERN = re.compile(r'deg(-?[0-9.]+)_')
+ABSORBANCE_FILE_STR = 'Abs'
+
+
+def get_angle_data_from_dir(directory, convert_units=None, data_format=None, workers=None):
 	"""
 	Extracts angle-resolved and absorbance data from each file in the supplied directory.
 	x-axis data is assumed to be in cm-1, but you can convert to other units here.
+	Files are loaded concurrently (see load_angle_dir).
 	
 	convert_units: This should be a tuple containing the input units and the desired output units
 				   Available units are in the pmath Convert class.
 				   Example: convert_units = ('cm-1', 'um')
 	"""
+	index = index_angle_dir(directory)
+	spectra, absorbance_data = load_spectra(index, convert_units, workers)
+	angle_data = [[deg, x_data, intensity] for deg, (x_data, intensity) in zip(index['angles'], spectra)]
+	return angle_data, absorbance_data
 
-	abs_wavenum = np.array([]) 			 # absorbance wavenumbers
-	abs_intensity = np.array([])			 # absorbance intensities
-	angle_data = []  # List with structure [[angle, [wavenumbers, intensities]], [...], ...]
 
-	#TODO: spectrum = spectrum.lower()
-	deg_str = 'deg'
-	abs_str = 'Abs'
+def index_angle_dir(directory):
+	"""
+	Build an index of an angle-resolved directory from the file names alone.
+	Inputs: directory named concentration_solute_in_solvent with degNUM_ angle
+			files and an Abs absorbance file.
+	Outputs: dictionary with the sample name and parameters (get_sample_params),
+			 the sorted angles, their file paths and the absorbance file path
+			 (None if there is no absorbance file).
+	"""
+	sample_name, params = get_sample_params(str(directory))
+	angle_files = []
+	abs_file = None
+	for spectrum in sorted(os.listdir(directory)):
+		if not spectrum.endswith('.csv'):
+			continue
+		spec_file = os.path.join(directory, spectrum)
+		match = ANGLE_FILE_PATTERN.search(spectrum)
+		if match:
+			angle_files.append((float(match.group(1)), spec_file))
+		if ABSORBANCE_FILE_STR in spectrum and abs_file is None:
+			abs_file = spec_file
+	angle_files.sort(key=lambda angle_file: angle_file[0])
+
+	return {
+		'sample': sample_name,
+		'params': params,
+		'angles': [deg for deg, spec_file in angle_files],
+		'files': [spec_file for deg, spec_file in angle_files],
+		'absorbance': abs_file,
+		}
+
+
+def load_spectra(index, convert_units=None, workers=None):
+	"""
+	Load the angle and absorbance files of a directory index with a thread pool.
+	convert_units (see get_angle_data_from_dir) applies to the angle files
+	only; the absorbance data keeps the units of its file.
+	Outputs: list of (x_data, intensity) in the order of index['angles'],
+			 absorbance data stacked as (2, N) (empty if there is no file).
+	"""
+	files = list(index['files'])
+	if index['absorbance']:
+		files.append(index['absorbance'])
+	with ThreadPoolExecutor(max_workers=workers) as pool:
+		spectra = list(pool.map(get_FTIR_data, files))
 
-	for spectrum in os.listdir(directory):
-		if spectrum.endswith('.csv'):
-			spec_file = str(directory) + '/' + str(spectrum)
-			if deg_str in spectrum:
-				# Get the angle of the measurement from file string
-				deg_s = spectrum.find(deg_str) + len(deg_str)
-				deg_e = spectrum.find('_', deg_s)
-				deg = float(spectrum[deg_s:deg_e])
-				x_data, intensity = get_FTIR_data(spec_file)
+	absorbance_data = np.stack(spectra.pop()) if index['absorbance'] else np.empty((2, 0))
+	if convert_units:
+		spectra = [(pmath.set_units(x_data, convert_units[0], convert_units[1]), intensity)
+			for x_data, intensity in spectra]
+	return spectra, absorbance_data
 
-				if convert_units:
-					x_data = pmath.set_units(x_data, convert_units[0], convert_units[1])
 
-				angle_data.append([deg, x_data, intensity])
+def load_angle_dir(directory, convert_units=None, workers=None):
+	"""
+	Load an angle-resolved directory into a single array.
+	Every spectrum is put on the x-axis of the first angle, interpolating
+	the spectra that were measured on a different axis.
+	Outputs: angles (A,), x-axis (N,), intensities (A, N), absorbance data (2, M)
+			 and the directory index (see index_angle_dir).
+	"""
+	index = index_angle_dir(directory)
+	if not index['angles']:
+		raise FileNotFoundError("No angle-resolved spectra in {}".format(directory))
+	spectra, absorbance_data = load_spectra(index, convert_units, workers)
+	x_axis, intensities = stack_spectra(spectra)
+	return np.array(index['angles']), x_axis, intensities, absorbance_data, index
 
-			# Get absorbance data if the file exists (it should always exist)
-			if abs_str in spectrum:
-				abs_wavenum, abs_intensity = get_FTIR_data(spec_file)
 
-	absorbance_data = np.stack((abs_wavenum, abs_intensity))
-	angle_data.sort()
-	
-	return angle_data, absorbance_data
+def stack_spectra(spectra):
+	"""
+	Stack spectra into one array on the x-axis of the first spectrum.
+	Spectra measured on a different axis are interpolated onto it
+	(NaN outside their range).
+	Inputs: list of (x_data, intensity) pairs.
+	Outputs: x-axis (N,), intensities (number of spectra, N).
+	"""
+	x_axis = np.asarray(spectra[0][0], dtype=float)
+	intensities = np.empty((len(spectra), x_axis.size))
+	for row, (x_data, intensity) in zip(intensities, spectra):
+		x_data = np.asarray(x_data, dtype=float)
+		if x_data.shape == x_axis.shape and np.allclose(x_data, x_axis):
+			row[:] = intensity
+		else:
+			order = np.argsort(x_data)
+			row[:] = np.interp(x_axis, x_data[order], np.asarray(intensity)[order], left=np.nan, right=np.nan)
+	return x_axis, intensities
 
 
 def get_param_from_string(string, separator):
@@ -180,6 +291,13 @@ def from_tmm(directories, angle_index=0):
 	
 	for i, p in enumerate(df['Path']):
 		simlist = os.listdir(p)
+		if results.RESULT_FILE in simlist:
+			result = results.load_result(p)
+			out_df[df['Sample'][i]] = result.unpolarized()[0][angle_index]
+			if i == 0:
+				out_df['Wavenumber'] = result.wavenumbers
+			continue
+
 		spectrum = os.path.join(p, simlist[angle_index])
 		transmittance = pd.read_csv(spectrum, usecols=['Transmittance'])
 		out_df[df['Sample'][i]] = transmittance['Transmittance']
@@ -194,45 +312,115 @@ def from_tmm(directories, angle_index=0):
 	return out_df
 
 
+# ============== Binary cache for data files ============== #
+
+DATASET_CACHE = 'cache'  # Sidecar folder next to each csv file
+dataset_store = {}  # (path, mtime, size) -> dataset, for the current process
+
+
+def dataset_cache_path(csv_path, cache_dir=None):
+	"""
+	Sidecar .npy path for a csv file. The name holds the modification time
+	and size of the csv file, so an edited file gets a new sidecar.
+	"""
+	csv_path = os.path.abspath(csv_path)
+	stat = os.stat(csv_path)
+	if cache_dir is None:
+		cache_dir = os.path.join(os.path.dirname(csv_path), DATASET_CACHE)
+	name = os.path.splitext(os.path.basename(csv_path))[0]
+	return os.path.join(cache_dir, '{}_{}_{}.npy'.format(name, stat.st_mtime_ns, stat.st_size))
+
+
+def read_dataset(csv_path, cache_dir=None):
+	"""
+	Read a csv data file (angle-resolved spectra, dispersion, splitting fit)
+	as a read-only numpy structured array with one field per csv column,
+	e.g. dataset['Wavenumber (cm-1)'].
+
+	The csv file is only parsed the first time it is read. It is saved as a
+	binary .npy sidecar in a cache folder next to the file and memory-mapped
+	on later reads, so only the columns that are used are loaded from disk.
+	The sidecar is replaced when the modification time or size of the csv
+	file changes. pd.DataFrame(dataset) gives the same table as pd.read_csv.
+	"""
+	npy_path = dataset_cache_path(csv_path, cache_dir)
+	key = (os.path.abspath(csv_path), os.path.basename(npy_path))
+	if key in dataset_store:
+		return dataset_store[key]
+
+	if os.path.exists(npy_path):
+		dataset = np.load(npy_path, mmap_mode='r')
+	else:
+		dataset = dataframe_to_records(pd.read_csv(csv_path))
+		dataset.flags.writeable = False
+		try:
+			os.makedirs(os.path.dirname(npy_path), exist_ok=True)
+			name = os.path.splitext(os.path.basename(csv_path))[0]
+			sidecar = re.compile(re.escape(name) + r'_\d+_\d+\.npy')
+			stale = [path for path in glob.glob(os.path.join(os.path.dirname(npy_path), glob.escape(name) + '_*.npy'))
+				if sidecar.fullmatch(os.path.basename(path))]
+			tmp_path = npy_path + '.{}.tmp'.format(os.getpid())
+			with open(tmp_path, 'wb') as f:
+				np.save(f, dataset)
+			os.replace(tmp_path, npy_path)
+			for old_path in stale:
+				os.remove(old_path)
+		except OSError:
+			pass  # Read-only data directory; parse the csv again next session
+
+	dataset_store[key] = dataset
+	return dataset
+
+
+def read_datasets(pattern, cache_dir=None):
+	"""
+	Read every csv file matching a glob pattern with read_dataset,
+	e.g. read_datasets('data/DPPA_in_*/*_dispersion.csv').
+	Outputs: dictionary of datasets keyed by file name without extension.
+	"""
+	return {os.path.splitext(os.path.basename(path))[0]: read_dataset(path, cache_dir)
+		for path in sorted(glob.glob(pattern))}
+
+
+def dataframe_to_records(df):
+	"""Structured array with the columns of a DataFrame. Text columns are stored as unicode."""
+	dtype = []
+	for name in df.columns:
+		column = df[name]
+		if column.dtype.kind in 'biuf':
+			dtype.append((str(name), column.dtype))
+		else:
+			width = max(1, column.astype(str).str.len().max()) if len(column) else 1
+			dtype.append((str(name), 'U{}'.format(width)))
+	records = np.empty(len(df), dtype=dtype)
+	for name, (field, field_type) in zip(df.columns, dtype):
+		records[field] = df[name].astype(str) if str(field_type).startswith('U') else df[name]
+	return records
+
+
 # ============== Write results to files ============== #
 
 def write_angle_spec_to_file(angle_data_list, sample_name, out_path):
 	"""Takes angles list, wavenumber list, and intensity list.
 		Writes angle-resolved data to csv file with
 		wavenumber in leftmost column (x-axis), and intensities
-		for each degree (y-axes)."""
+		for each degree (y-axes). Spectra measured on different
+		wavenumbers are resampled onto those of the first angle."""
 
-	angles = []
-	wavenumbers = angle_data_list[0][1]
-	num_wavenums = len(wavenumbers)
+	wavenumbers, intensities = stack_spectra([(a[1], a[2]) for a in angle_data_list])
+	header = ['Wavenumber (cm-1)'] + ['Int deg' + str(a[0]) + ' (arb)' for a in angle_data_list]
 
 	angle_res_file = sample_name + '_angle-resolved_spectra.csv'
 	output = os.path.join(os.path.abspath(out_path), angle_res_file)
 	with open(output, 'w') as out_file:
-		filewriter= csv.writer(out_file, delimiter=',')
-		header = ['Wavenumber (cm-1)']
-		for a in angle_data_list:
-			angle = a[0]
-			header.append('Int deg' + str(angle) + ' (arb)')
+		filewriter = csv.writer(out_file, delimiter=',')
 		filewriter.writerow(header)
-
-		i = 0
-		# BIG ASSUMPTION: all data sets have same number of wavenumbers with the same values
-		while i < num_wavenums:
-			# Cycle through data points, first set up wavenumbers
-			row = [wavenumbers[i]]
-
-			for item in angle_data_list:
-				# Cycle through data point for each degree, make a row
-				row.append(item[2][i])
-
-			filewriter.writerow(row)
-			i+=1
+		# Python floats are written in their shortest round-trip form
+		filewriter.writerows(np.column_stack((wavenumbers, intensities.T)).tolist())
 
 	print('Wrote angle-resolved spectra results to {}\n'.format(output))
 
 
-
 def main():
 	"None"
 
@@ -7,6 +7,7 @@ import numpy as np
 import matplotlib.pyplot as plt
 import matplotlib.ticker as ticker
 import seaborn as sns
+import results
 
 
 def plot_spectra(dataframe, rawpath, ax, offset=0):
@@ -33,8 +34,12 @@ def plot_spectra(dataframe, rawpath, ax, offset=0):
 def get_angle_data(simulation_path):
 	"""
 	Retrieve angles, transmission amplitudes, wavenumbers
-	from transfer matrix calculations.
+	from transfer matrix calculations. Reads the binary result file if the
+	simulation has one, otherwise the csv file for each angle.
 	"""
+	if os.path.isfile(simulation_path) or results.RESULT_FILE in os.listdir(simulation_path):
+		return results.load_result(simulation_path).angle_data()
+
 	angle_files = ns.realsorted(os.listdir(simulation_path))
 	angle_data = []
 	wavenumber_data = []
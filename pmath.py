@@ -1,3 +1,5 @@
+import os
+import inspect
 import numpy as np
 import scipy.fftpack as fft
 from scipy import constants
@@ -5,6 +7,7 @@ from scipy import optimize
 import matplotlib.pyplot as plt
 import matplotlib.ticker as ticker
 import csv
+from concurrent.futures import ProcessPoolExecutor
 
 
 # =============== Experiment-Specific Calculations =============== #
@@ -210,6 +213,148 @@ def optimize_df(x, theta, E_up, E_lp):
 	return jacobian
 
 
+FIT_BLOCK_SIZE = 8  # Minimum number of neighbouring angles fitted in a row by one worker
+FIT_RTOL = 1e-4  # Relative tolerance for a block to match the fit started from its neighbour
+
+
+def peak_param_names(lineshape):
+	"""Parameter names of a lineshape function f(w, amp, w_0, ...), without w."""
+	return list(inspect.signature(lineshape).parameters)[1:]
+
+
+def two_peaks(w, lineshape, *params):
+	"""Sum of a lower and an upper peak; params holds the lower peak parameters first."""
+	num_params = len(params) // 2
+	return lineshape(w, *params[:num_params]) + lineshape(w, *params[num_params:])
+
+
+def fit_peak_block(x_data, intensities, guess, lineshape, bounds, maxfev):
+	"""
+	Fit two peaks to each spectrum of a block in turn, starting each fit
+	from the solution for the previous spectrum.
+	Outputs: parameters (spectra, 2 * parameters per peak), success flags.
+	"""
+	params = np.full((len(intensities), len(guess)), np.nan)
+	success = np.zeros(len(intensities), dtype=bool)
+	p0 = np.asarray(guess, dtype=float)
+	model = lambda w, *peak_params: two_peaks(w, lineshape, *peak_params)
+
+	for i, (x, y) in enumerate(zip(x_data, intensities)):
+		finite = np.isfinite(x) & np.isfinite(y)
+		try:
+			popt, pcov = optimize.curve_fit(model, x[finite], y[finite], p0=p0, bounds=bounds, maxfev=maxfev)
+		except (RuntimeError, ValueError):
+			continue  # Keep warm starting from the last converged angle
+		params[i] = popt
+		success[i] = True
+		p0 = popt
+	return params, success
+
+
+def fit_polariton_peaks(angles, x_data, intensities, guess, lineshape=asym_voigt, bounds=(-np.inf, np.inf),
+						x_range=None, workers=None, maxfev=10000, seed=0, block_size=FIT_BLOCK_SIZE):
+	"""
+	Fit the lower and upper polariton peaks of every angle of an angle-resolved
+	data set, e.g. from data_io.load_angle_dir.
+
+	The seed angle (index into angles, where guess was made) is fitted first
+	and every other angle is fitted starting from the solution for its
+	neighbour, working outward from the seed. To fit in parallel, the angles
+	on either side of the seed are split into contiguous blocks of at least
+	block_size angles. The first angle of each block is fitted in turn
+	starting from the previous block's first angle, which gives a start for
+	each block, then the blocks are fitted by a process pool. Afterwards the
+	first angle of each block is fitted again from the last angle of the
+	previous block. Where that does not give the same solution, the block
+	was started too far from its peaks and is fitted again from there, so
+	the result is the same as fitting every angle in a row.
+
+	Inputs: angles (A,), x-axis (N,) shared by every angle or (A, N),
+			intensities (A, N), initial guess for the lower peak parameters
+			followed by the upper peak parameters (e.g. amp, w_0, gamma, a, m
+			for asym_voigt), lineshape function f(w, amp, w_0, ...), bounds as
+			in scipy.optimize.curve_fit, optional (min, max) x-axis range to
+			fit, number of processes (1 fits in this process), index of the
+			angle guess was made for and minimum number of angles per block.
+	Outputs: parameter table as a numpy structured array with one row per
+			 angle and fields angle, LP_<param>, UP_<param> and success.
+			 pd.DataFrame(table) gives a DataFrame. The peak with the lower
+			 center is always reported as the lower polariton.
+	"""
+	angles = np.asarray(angles, dtype=float)
+	intensities = np.asarray(intensities, dtype=float)
+	x_data = np.broadcast_to(np.asarray(x_data, dtype=float), intensities.shape)
+	if x_range is not None:
+		mask = (x_data >= x_range[0]) & (x_data <= x_range[1])
+		x_data = np.where(mask, x_data, np.nan)  # NaN points are left out of each fit
+
+	names = peak_param_names(lineshape)
+	num_params = len(names)
+	if len(guess) != 2*num_params:
+		raise ValueError("Expected {} initial parameters, two of each of {}".format(2*num_params, names))
+	fit_args = (lineshape, bounds, maxfev)
+
+	if workers is None:
+		workers = os.cpu_count() or 1
+	seed = range(len(angles))[seed]
+	seed_params, seed_success = fit_peak_block(x_data[[seed]], intensities[[seed]], guess, *fit_args)
+	seed_start = seed_params[0] if seed_success[0] else np.asarray(guess, dtype=float)
+
+	# Blocks of angles running outward from the seed, each with a solution to start from
+	chains = []
+	tasks = []
+	for chain in (np.arange(seed, len(angles)), np.arange(seed - 1, -1, -1)):
+		if len(chain) == 0:
+			continue
+		num_blocks = max(1, min(-(-workers * len(chain) // len(angles)), len(chain) // block_size))
+		chain_blocks = np.array_split(chain, num_blocks)
+		firsts = [block[0] for block in chain_blocks]
+		first_params, first_success = fit_peak_block(x_data[firsts], intensities[firsts], seed_start, *fit_args)
+		start = seed_start
+		for block, block_params, block_success in zip(chain_blocks, first_params, first_success):
+			if block_success:
+				start = block_params
+			tasks.append((x_data[block], intensities[block], start) + fit_args)
+		chains.append(chain_blocks)
+
+	blocks = [block for chain_blocks in chains for block in chain_blocks]
+	if workers == 1 or len(tasks) == 1:
+		fits = [fit_peak_block(*task) for task in tasks]
+	else:
+		with ProcessPoolExecutor(max_workers=min(workers, len(tasks))) as pool:
+			fits = list(pool.map(fit_peak_block, *zip(*tasks)))
+	params = np.full((len(angles), len(guess)), np.nan)
+	success = np.zeros(len(angles), dtype=bool)
+	for block, (block_params, block_success) in zip(blocks, fits):
+		params[block] = block_params
+		success[block] = block_success
+
+	# Check each block against a fit of its first angle from the angle before it
+	for chain_blocks in chains:
+		start = seed_start
+		for idx, block in enumerate(chain_blocks):
+			if idx > 0:
+				check, _ = fit_peak_block(x_data[block[:1]], intensities[block[:1]], start, *fit_args)
+				if not np.allclose(check[0], params[block[0]], rtol=FIT_RTOL, equal_nan=True):
+					params[block], success[block] = fit_peak_block(x_data[block], intensities[block], start, *fit_args)
+			converged = block[success[block]]
+			if len(converged):
+				start = params[converged[-1]]  # Keep warm starting from the last converged angle
+
+	# Order the two peaks by center so the lower polariton comes first
+	center = names.index('w_0') if 'w_0' in names else 1
+	swap = params[:, center] > params[:, num_params + center]
+	params[swap] = np.concatenate((params[swap, num_params:], params[swap, :num_params]), axis=1)
+
+	fields = ['angle'] + ['LP_' + name for name in names] + ['UP_' + name for name in names]
+	table = np.zeros(len(angles), dtype=[(field, float) for field in fields] + [('success', bool)])
+	table['angle'] = angles
+	for i, field in enumerate(fields[1:]):
+		table[field] = params[:, i]
+	table['success'] = success
+	return table
+
+
 # =============== Unit Conversions =============== #
 
 
@@ -0,0 +1,450 @@
+#!/usr/bin/env python
+
+"""
+Name: Results
+Author: Garrek Stemo
+Affiliation: Nara Institute of Science and Technology
+
+Containers and writers for transfer matrix results. Spectra are kept in
+memory as arrays on an (angle, wavelength) grid so they can be used directly
+from Python. On disk a simulation is stored as one binary result file
+(see ResultStore); csv files can be exported from it.
+
+Usage: python results.py sim_path/spectra.tmm output_dir
+converts a result file to one csv file per angle.
+"""
+
+import argparse
+import csv
+import json
+import os
+import queue
+import shutil
+import threading
+import numpy as np
+
+POLARIZATIONS = ['s-wave', 'p-wave']  # Order of the polarization axis for mixed waves
+SPECTRA = ['Transmittance', 'Reflectance', 'Absorptance']
+RESULT_FILE = 'spectra.tmm'  # Name of the result file in each simulation folder
+RESULT_MAGIC = b'PSTMM001'  # First bytes of every result file
+RESULT_ALIGNMENT = 64  # Byte alignment of the arrays inside a result file
+USER_CACHE = os.environ.get('PISTACHIO_CACHE') or os.path.join(
+	os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache'), 'pistachio')  # Per-user cache folder
+RESULT_CACHE = os.path.join(USER_CACHE, 'results')  # Cached result files
+RESULT_CACHE_SIZE = 2048  # Maximum size (MB) of the result cache before least recently used files are removed
+WRITER_QUEUE_SIZE = 16  # Blocks of spectra computed but not yet written before workers wait
+
+
+class SimulationResult:
+	"""
+	Transmittance, reflectance and absorptance of a device for every angle
+	(degrees) and wavelength (um) of a simulation.
+
+	Each spectrum array has shape (number of angles, number of wavelengths).
+	For mixed waves the arrays have a leading polarization axis ordered as in
+	POLARIZATIONS; use unpolarized() or polarization() to pick spectra out.
+	"""
+	def __init__(self, angles, wavelengths, transmittance, reflectance, absorptance,
+				 wave_type='mixed', config=None):
+		self.angles = np.asarray(angles, dtype=float)
+		self.wavelengths = np.asarray(wavelengths, dtype=float)
+		self.transmittance = transmittance
+		self.reflectance = reflectance
+		self.absorptance = absorptance
+		self.wave_type = wave_type
+		self.config = config  # Device dictionary the spectra were computed from
+
+	def __repr__(self):
+		a = "SimulationResult ({})\n".format(self.wave_type)
+		b = "angles: {} in range [{}, {}]\n".format(len(self.angles), self.angles.min(), self.angles.max())
+		c = "wavelengths: {} in range [{}, {}]\n".format(len(self.wavelengths), self.wavelengths.min(), self.wavelengths.max())
+		return a+b+c
+
+	@property
+	def wavenumbers(self):
+		"""Wavenumbers in cm-1 for each wavelength."""
+		return 10**4 / self.wavelengths
+
+	def angle_index(self, angle):
+		"""Index of the simulated angle closest to angle (degrees)."""
+		return int(np.argmin(np.abs(self.angles - angle)))
+
+	def polarization(self, wave_type):
+		"""Transmittance, reflectance and absorptance for 's-wave' or 'p-wave'."""
+		spectra = (self.transmittance, self.reflectance, self.absorptance)
+		if self.wave_type == 'mixed':
+			idx = POLARIZATIONS.index(wave_type)
+			return tuple(s[idx] for s in spectra)
+		elif wave_type == self.wave_type:
+			return spectra
+		raise ValueError("{} result has no {} spectra".format(self.wave_type, wave_type))
+
+	def unpolarized(self):
+		"""Transmittance, reflectance and absorptance, averaged over s and p
+		   for mixed waves."""
+		spectra = (self.transmittance, self.reflectance, self.absorptance)
+		if self.wave_type == 'mixed':
+			return tuple(np.mean(s, axis=0) for s in spectra)
+		return spectra
+
+	def angle_data(self):
+		"""
+		Same structure as plots.get_angle_data:
+		[angles, wavenumbers, transmission for each angle].
+		"""
+		transmittance = self.unpolarized()[0]
+		return [list(self.angles), self.wavenumbers, list(transmittance)]
+
+	def save(self, path, family=None):
+		"""Writes the result to a single binary result file (see ResultStore)."""
+		store = ResultStore.create(path, self.angles, self.wavelengths, self.wave_type, self.config, family)
+		store.write(slice(None), slice(None), self.transmittance, self.reflectance, self.absorptance)
+		store.flush()
+		return path
+
+	def write_csv(self, output_dir):
+		"""Writes one csv file per angle (see write_tmm_results)."""
+		if not os.path.exists(output_dir):
+			os.makedirs(output_dir)
+		spectra = (self.transmittance, self.reflectance, self.absorptance)
+		for idx, angle in enumerate(self.angles):
+			header, columns = spectra_columns(*[s[..., idx, :] for s in spectra], self.wave_type)
+			write_tmm_results(angle, output_dir, [self.wavelengths] + columns, header)
+
+
+class ResultStore:
+	"""
+	Binary file holding all spectra of one simulation.
+
+	Layout: RESULT_MAGIC, header length (uint64), a JSON header with the
+	angles, wavelengths, wave type and device config, then a mask of the
+	(angle, wavelength) points already computed, then the spectra as
+	float64 with shape (angles, polarizations, 3, wavelengths). The last
+	two are memory-mapped, so opening a file reads only the header and
+	spectra are loaded from disk as they are used.
+	"""
+	def __init__(self, path, mode='r'):
+		self.path = path
+		with open(path, 'rb') as f:
+			if f.read(len(RESULT_MAGIC)) != RESULT_MAGIC:
+				raise ValueError("{} is not a transfer matrix result file".format(path))
+			header_length = int(np.frombuffer(f.read(8), dtype='<u8')[0])
+			self.header = json.loads(f.read(header_length).decode('utf8'))
+
+		self.angles = np.array(self.header['angles'])
+		self.wavelengths = np.array(self.header['wavelengths'])
+		self.wave_type = self.header['wave_type']
+		self.config = self.header['config']
+		self.family = self.header.get('family')
+		shape = tuple(self.header['shape'])
+		grid_shape = (shape[0], shape[-1])
+		mask_offset = result_offset(len(RESULT_MAGIC) + 8 + header_length)
+		data_offset = result_offset(mask_offset + np.prod(grid_shape))
+		self.mask = np.memmap(path, dtype=np.bool_, mode=mode, offset=mask_offset, shape=grid_shape)
+		self.data = np.memmap(path, dtype='<f8', mode=mode, offset=data_offset, shape=shape)
+
+	@classmethod
+	def create(cls, path, angles, wavelengths, wave_type, config=None, family=None):
+		"""Makes an empty result file for the grid and opens it for writing.
+		   family identifies results of the same device on other grids
+		   (see transfer_matrix.family_key and merge_results)."""
+		num_pol = len(POLARIZATIONS) if wave_type == 'mixed' else 1
+		shape = [len(angles), num_pol, len(SPECTRA), len(wavelengths)]
+		header = {
+			'wave_type': wave_type,
+			'shape': shape,
+			'angles': [float(a) for a in angles],
+			'wavelengths': [float(wl) for wl in wavelengths],
+			'config': config,
+			'family': family,
+			}
+		header = json.dumps(header, default=str).encode('utf8')
+		mask_offset = result_offset(len(RESULT_MAGIC) + 8 + len(header))
+		data_offset = result_offset(mask_offset + shape[0]*shape[-1])
+
+		with open(path, 'wb') as f:
+			f.write(RESULT_MAGIC)
+			f.write(np.array(len(header), dtype='<u8').tobytes())
+			f.write(header)
+			f.truncate(data_offset + int(np.prod(shape)) * 8)
+		return cls(path, mode='r+')
+
+	def write(self, angle_idx, wl_idx, transmittance, reflectance, absorptance):
+		"""
+		Stores the spectra of one block of the grid. angle_idx and wl_idx are
+		indices or slices; the spectra have the layout returned by
+		transfer_matrix_grid (or calculate_spectra for a single angle).
+		"""
+		for i, spectrum in enumerate((transmittance, reflectance, absorptance)):
+			if self.wave_type == 'mixed':
+				self.data[angle_idx, :, i, wl_idx] = np.moveaxis(spectrum, 0, -2)
+			else:
+				self.data[angle_idx, 0, i, wl_idx] = spectrum
+		self.mask[angle_idx, wl_idx] = True
+
+	def flush(self):
+		self.data.flush()
+		self.mask.flush()
+
+	def result(self):
+		"""SimulationResult whose spectra are memory-mapped views of the file."""
+		spectra = [self.data[:, :, i, :] for i in range(len(SPECTRA))]
+		if self.wave_type == 'mixed':
+			spectra = [np.moveaxis(s, 1, 0) for s in spectra]
+		else:
+			spectra = [s[:, 0, :] for s in spectra]
+		return SimulationResult(self.angles, self.wavelengths, *spectra, self.wave_type, self.config)
+
+
+class ResultWriter(threading.Thread):
+	"""
+	Background thread that writes blocks of spectra to a ResultStore as they
+	are computed, so disk I/O overlaps with the calculation.
+
+	Call reserve() before starting each block. It waits while max_pending
+	blocks are computed or queued but not yet written, which keeps a fast
+	calculation from piling up results in memory. Blocks are handed over
+	with put() (or fail() if the calculation raised) and close() waits for
+	everything to be written. The store's mask is flushed after each block,
+	so finished angles can be read from the file before the run ends.
+	"""
+	def __init__(self, store, max_pending=WRITER_QUEUE_SIZE, progress=None):
+		super().__init__(daemon=True)
+		self.store = store
+		self.progress = progress  # Called with the number of grid points in each block written
+		self.queue = queue.Queue(max_pending)
+		self.slots = threading.Semaphore(max_pending)
+		self.error = None
+
+	def reserve(self):
+		self.slots.acquire()
+
+	def put(self, angle_idx, wl_idx, spectra):
+		self.queue.put((angle_idx, wl_idx, spectra))
+
+	def fail(self, error):
+		self.error = error
+		self.slots.release()
+
+	def run(self):
+		while True:
+			block = self.queue.get()
+			if block is None:
+				break
+			angle_idx, wl_idx, spectra = block
+			try:
+				self.store.write(angle_idx, wl_idx, *spectra)
+				self.store.flush()
+			except Exception as error:
+				self.error = error
+			self.slots.release()
+			if self.progress is not None:
+				self.progress(self.store.mask[angle_idx, wl_idx].size)
+
+	def close(self):
+		"""Waits for all queued blocks to be written."""
+		self.queue.put(None)
+		self.join()
+		if self.error is not None:
+			raise self.error
+
+
+def matching_indices(values, existing, rtol=1e-9):
+	"""
+	Inputs: two 1-D arrays, e.g. angles of a new grid and of an existing result.
+	Outputs: index arrays i, j such that values[i] equals existing[j] (to
+			 within rtol).
+	"""
+	values = np.asarray(values, dtype=float)
+	existing = np.asarray(existing, dtype=float)
+	if len(existing) == 0:
+		return np.array([], dtype=int), np.array([], dtype=int)
+	order = np.argsort(existing)
+	sorted_existing = existing[order]
+	pos = np.searchsorted(sorted_existing, values)
+	left = (pos - 1).clip(0, len(existing) - 1)
+	right = pos.clip(0, len(existing) - 1)
+	nearest = np.where(np.abs(sorted_existing[left] - values) <= np.abs(sorted_existing[right] - values), left, right)
+	found = np.isclose(sorted_existing[nearest], values, rtol=rtol, atol=1e-12)
+	return np.nonzero(found)[0], order[nearest[found]]
+
+
+def find_results(family, paths):
+	"""Opens the result files among paths that hold spectra of the given family."""
+	stores = []
+	for path in paths:
+		try:
+			store = ResultStore(path)
+		except (OSError, ValueError):
+			continue
+		if family is not None and store.family == family:
+			stores.append(store)
+	return stores
+
+
+def merge_results(store, sources):
+	"""
+	Copies into store every (angle, wavelength) point that one of the source
+	stores has computed and store has not yet got, marking it in the mask.
+	Output: number of points copied.
+	"""
+	copied = 0
+	for source in sources:
+		if source.wave_type != store.wave_type:
+			continue
+		new_a, old_a = matching_indices(store.angles, source.angles)
+		new_w, old_w = matching_indices(store.wavelengths, source.wavelengths)
+		for na, oa in zip(new_a, old_a):
+			take = source.mask[oa, old_w] & ~store.mask[na, new_w]
+			if take.any():
+				store.data[na][..., new_w[take]] = source.data[oa][..., old_w[take]]
+				store.mask[na, new_w[take]] = True
+				copied += int(take.sum())
+	return copied
+
+
+def result_offset(offset):
+	"""Rounds a byte offset in a result file up to RESULT_ALIGNMENT."""
+	return -(-int(offset) // RESULT_ALIGNMENT) * RESULT_ALIGNMENT
+
+
+def load_result(path):
+	"""
+	Input: a result file, or a simulation folder containing RESULT_FILE.
+	Output: SimulationResult with memory-mapped spectra.
+	"""
+	if os.path.isdir(path):
+		path = os.path.join(path, RESULT_FILE)
+	return ResultStore(path).result()
+
+
+def export_csv(path, output_dir):
+	"""Converts a result file to one csv file per angle in output_dir."""
+	load_result(path).write_csv(output_dir)
+
+
+def link_file(path, new_path):
+	"""
+	Makes new_path a hard link to the result file at path, so both names
+	share the data on disk, or a copy where links are not possible (e.g. on
+	another file system). Result files are replaced, not edited, once
+	written, so a link is never changed through the other name.
+	"""
+	try:
+		os.link(path, new_path)
+	except OSError:
+		shutil.copyfile(path, new_path)
+
+
+def cached_result(key, cache_dir=RESULT_CACHE):
+	"""Path of the cached result file for key (see transfer_matrix.device_key)
+	   or None. A hit marks the file as recently used."""
+	path = os.path.join(cache_dir, key + os.path.splitext(RESULT_FILE)[1])
+	if not os.path.exists(path):
+		return None
+	try:
+		os.utime(path)
+	except OSError:
+		pass  # Read-only cache; the result can still be used
+	return path
+
+
+def cache_result(result, key, cache_dir=RESULT_CACHE, max_size=RESULT_CACHE_SIZE, move=False, family=None):
+	"""
+	Adds a SimulationResult or an existing result file to the cache under key,
+	then removes least recently used files until the cache fits in max_size MB.
+	A result file is hard linked into the cache (see link_file), or with
+	move renamed into it. family is stored with a SimulationResult so
+	later runs can reuse its points (see merge_results).
+	Output: path of the cached file, or None if the cache directory cannot
+			be written (the result is then simply not cached).
+	"""
+	path = os.path.join(cache_dir, key + os.path.splitext(RESULT_FILE)[1])
+	tmp_path = path + '.{}.tmp'.format(os.getpid())
+	try:
+		os.makedirs(cache_dir, exist_ok=True)
+		if isinstance(result, SimulationResult):
+			result.save(tmp_path, family)
+		elif move:
+			tmp_path = result
+		elif os.path.exists(path) and os.path.samefile(result, path):
+			tmp_path = path  # Already the cached file
+		else:
+			link_file(result, tmp_path)
+		os.replace(tmp_path, path)
+		evict_cache(cache_dir, max_size)
+	except OSError:
+		if tmp_path != result and os.path.exists(tmp_path):
+			os.remove(tmp_path)
+		return None
+	return path
+
+
+def evict_cache(cache_dir=RESULT_CACHE, max_size=RESULT_CACHE_SIZE):
+	"""Removes the least recently used result files (oldest modification
+	   time, see cached_result) until the cache fits in max_size MB."""
+	ext = os.path.splitext(RESULT_FILE)[1]
+	entries = []
+	for name in os.listdir(cache_dir):
+		if name.endswith(ext):
+			stat = os.stat(os.path.join(cache_dir, name))
+			entries.append((stat.st_mtime_ns, stat.st_size, name))
+	entries.sort()
+
+	total = sum(size for _, size, _ in entries)
+	for _, size, name in entries:
+		if total <= max_size * 2**20:
+			break
+		os.remove(os.path.join(cache_dir, name))
+		total -= size
+
+
+def spectra_columns(transmittance, reflectance, absorptance, wave_type):
+	"""
+	Arrange spectra into output columns and matching header names.
+	For mixed waves the inputs have a leading polarization axis; the
+	unpolarized spectra (average of s and p) come first so files keep the
+	same leading columns as single polarization results, followed by the
+	s-wave and p-wave spectra.
+	"""
+	header = list(SPECTRA)
+	spectra = [transmittance, reflectance, absorptance]
+
+	if wave_type != 'mixed':
+		return header, spectra
+
+	columns = [np.mean(s, axis=0) for s in spectra]
+	names = list(header)
+	for idx, pol in enumerate(POLARIZATIONS):
+		columns += [s[idx] for s in spectra]
+		names += ['{} ({})'.format(h, pol[0]) for h in header]
+	return names, columns
+
+
+def write_tmm_results(angle, output_dir, rows, header=None):
+	"""Writes transmission, reflectance, abosorbance data to csv file.
+	   rows is a list of columns starting with wavelengths. header names the
+	   columns after wavelength (see spectra_columns)."""
+
+	if header is None:
+		header = list(SPECTRA)
+	file_name = 'deg' + str(angle) + '_.csv'  # Underscore is to make it work with reading in angle in another method
+	output_file = os.path.join(output_dir, file_name)
+
+	with open (output_file, 'w', encoding='utf8', newline='') as out_file:
+
+		filewriter = csv.writer(out_file, delimiter=',')
+		filewriter.writerow(['Wavelength'] + header)
+		filewriter.writerows(zip(*rows))
+
+
+def parse_arguments():
+	parser = argparse.ArgumentParser(description="Export a transfer matrix result file to csv files.")
+	parser.add_argument('result_path', help="Result file or simulation folder containing {}.".format(RESULT_FILE))
+	parser.add_argument('output_dir', help="Directory for the csv files.")
+	return parser.parse_args()
+
+
+if __name__ == '__main__':
+	args = parse_arguments()
+	export_csv(args.result_path, args.output_dir)
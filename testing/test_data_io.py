@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+"""
+Name: test_data_io
+Description: Experimental spectra are read from the csv files written by the
+			 JASCO FTIR software. The spectrum sits between a header of
+			 instrument settings and a footer of extended information, which
+			 can hold bytes that are not valid utf-8.
+
+			 This method tests:
+
+			 1. The numeric block is found from the XYDATA line, read in one
+			 	call and matches the spectrum written to the file, with the
+			 	header, footer and junk bytes skipped.
+
+			 2. Files with a different header length and no XYDATA line are
+			 	read the same way.
+
+			 3. An angle-resolved directory is indexed by file name, loaded
+			 	concurrently and stacked in angle order on the x-axis of the
+			 	first angle. Unit conversion leaves the absorbance file alone.
+
+			 4. Data csv files are read from a memory-mapped binary sidecar
+			 	after the first read, and an edited csv file replaces its
+			 	sidecar.
+
+			 5. Angle-resolved spectra are written to one csv file in a single
+			 	call, resampling spectra measured on other wavenumbers.
+"""
+
+import os
+import numpy as np
+import pandas as pd
+import data_io
+import pmath
+
+
+JASCO_HEADER = [
+	'TITLE,',
+	'DATA TYPE,INFRARED SPECTRUM',
+	'ORIGIN,JASCO',
+	'OWNER,',
+	'DATE,20/06/10',
+	'TIME,14:20:52',
+	'SPECTROMETER/DATA SYSTEM,JASCO Corp., FT/IR-4600typeA, Rev. 1.00',
+	'LOCALE,1041',
+	'RESOLUTION,',
+	'DELTAX,-0.964233',
+	'XUNITS,1/CM',
+	'YUNITS,ABSORBANCE',
+	'FIRSTX,4000',
+	'LASTX,1000',
+	'NPOINTS,{}',
+	'FIRSTY,0',
+	'MAXY,1',
+	'MINY,0',
+	'XYDATA',
+	]
+
+JASCO_FOOTER = b'\n\n##### Extended Information\n\n[Comments]\n\x81\x82\xff,abc\n'
+
+
+def jasco_file(path, wavenumbers, intensities, header):
+	"""Write a spectrum in the JASCO csv layout with a non utf-8 footer."""
+	lines = [line.format(len(wavenumbers)) for line in header]
+	lines += ['{},{}'.format(x, y) for x, y in zip(wavenumbers, intensities)]
+	with open(path, 'wb') as f:
+		f.write('\n'.join(lines).encode('utf8') + JASCO_FOOTER)
+	return path
+
+
+def test_FTIR_data(tmp_path):
+	"""
+	Read spectra with and without the XYDATA header line.
+	"""
+	wavenumbers = np.linspace(4000, 1000, 3112)
+	intensities = np.sin(wavenumbers / 100)
+
+	spectrum = jasco_file(tmp_path / 'deg5_.csv', wavenumbers, intensities, JASCO_HEADER)
+	x, y = data_io.get_FTIR_data(spectrum)
+	assert x.dtype == np.float64 and y.dtype == np.float64
+	np.testing.assert_allclose(x, wavenumbers)
+	np.testing.assert_allclose(y, intensities)
+
+	# Shorter header without the XYDATA line
+	spectrum = jasco_file(tmp_path / 'deg6_.csv', wavenumbers, intensities, JASCO_HEADER[:5])
+	x, y = data_io.get_FTIR_data(spectrum)
+	np.testing.assert_allclose(x, wavenumbers)
+	np.testing.assert_allclose(y, intensities)
+
+
+def test_angle_dir(tmp_path):
+	"""
+	Index and load an angle-resolved directory.
+	"""
+	directory = tmp_path / '1.5M_WCO6_in_hexane'
+	directory.mkdir()
+	wavenumbers = np.linspace(4000, 1000, 601)
+	angles = [10.0, -5.0, 0.0, 2.5]
+	for deg in angles:
+		jasco_file(directory / 'deg{}_sample.csv'.format(deg), wavenumbers, np.cos(wavenumbers / 100 + deg), JASCO_HEADER)
+	jasco_file(directory / 'Abs_WCO6.csv', wavenumbers, np.exp(-wavenumbers / 1000), JASCO_HEADER)
+	(directory / 'notes.txt').write_text('deg99_ not a spectrum')
+
+	index = data_io.index_angle_dir(str(directory) + '/')
+	assert index['sample'] == '1.5M_WCO6_in_hexane'
+	assert index['params'] == ['1.5M', 'WCO6', 'hexane']
+	assert index['angles'] == sorted(angles)
+	assert index['absorbance'].endswith('Abs_WCO6.csv')
+
+	deg, x_axis, intensities, absorbance, index = data_io.load_angle_dir(directory, workers=3)
+	np.testing.assert_array_equal(deg, sorted(angles))
+	np.testing.assert_allclose(x_axis, wavenumbers)
+	assert intensities.shape == (len(angles), wavenumbers.size)
+	for row, angle in zip(intensities, deg):
+		np.testing.assert_allclose(row, np.cos(wavenumbers / 100 + angle))
+	np.testing.assert_allclose(absorbance, [wavenumbers, np.exp(-wavenumbers / 1000)])
+
+	angle_data, absorbance_data = data_io.get_angle_data_from_dir(directory)
+	assert [spectrum[0] for spectrum in angle_data] == sorted(angles)
+	np.testing.assert_allclose(angle_data[1][2], intensities[1])
+
+	# Unit conversion applies to the angle files, not the absorbance file
+	angle_data, absorbance_data = data_io.get_angle_data_from_dir(directory, convert_units=('cm-1', 'ev'))
+	np.testing.assert_allclose(angle_data[0][1], pmath.set_units(wavenumbers, 'cm-1', 'ev'))
+	np.testing.assert_allclose(absorbance_data, absorbance)
+
+	# A spectrum measured on a different axis is interpolated onto the shared axis
+	coarse = np.linspace(4000, 1000, 301)
+	jasco_file(directory / 'deg20_sample.csv', coarse, coarse / 1000, JASCO_HEADER)
+	deg, x_axis, intensities, absorbance, index = data_io.load_angle_dir(directory)
+	np.testing.assert_allclose(intensities[-1], wavenumbers / 1000)
+
+
+def test_dataset_cache(tmp_path):
+	"""
+	Read a dispersion csv through the binary sidecar cache.
+	"""
+	csv_path = tmp_path / '0.5M_DPPA_in_DMF_dispersion.csv'
+	df = pd.DataFrame({
+		'Angle (deg)': np.arange(0, 22, 2),
+		'UP Wavenumber (cm-1)': np.linspace(2202, 2215, 11),
+		'Sample': ['DPPA'] * 11,
+		})
+	df.to_csv(csv_path, index=False)
+
+	dataset = data_io.read_dataset(csv_path)
+	npy_path = data_io.dataset_cache_path(csv_path)
+	assert os.path.isfile(npy_path)
+	pd.testing.assert_frame_equal(pd.DataFrame(dataset), pd.read_csv(csv_path))
+
+	data_io.dataset_store.clear()
+	dataset = data_io.read_dataset(csv_path)
+	assert isinstance(dataset, np.memmap)
+	np.testing.assert_array_equal(dataset['Angle (deg)'], df['Angle (deg)'])
+
+	# Editing the csv file changes its size and replaces the sidecar
+	df['UP Wavenumber (cm-1)'] += 1.0
+	df.iloc[:5].to_csv(csv_path, index=False)
+	dataset = data_io.read_dataset(csv_path)
+	np.testing.assert_allclose(dataset['UP Wavenumber (cm-1)'], df['UP Wavenumber (cm-1)'][:5])
+	assert not os.path.exists(npy_path)
+	assert os.listdir(os.path.dirname(npy_path)) == [os.path.basename(data_io.dataset_cache_path(csv_path))]
+
+	# Files whose names extend each other keep their own sidecars
+	extended_path = tmp_path / '0.5M_DPPA_in_DMF_dispersion_1.csv'
+	df.to_csv(extended_path, index=False)
+	data_io.read_dataset(extended_path)
+	df.to_csv(csv_path, index=False)
+	data_io.read_dataset(csv_path)
+	assert os.path.exists(data_io.dataset_cache_path(extended_path))
+	assert os.path.exists(data_io.dataset_cache_path(csv_path))
+
+	datasets = data_io.read_datasets(str(tmp_path / '*_dispersion.csv'))
+	assert list(datasets) == ['0.5M_DPPA_in_DMF_dispersion']
+
+
+def test_write_angle_spec(tmp_path):
+	"""
+	Write angle-resolved spectra and read them back.
+	"""
+	wavenumbers = np.linspace(500, 4000, 7261)
+	coarse = np.linspace(500, 4000, 3631)
+	angle_data = [[deg, wavenumbers, np.sin(wavenumbers / 100 + deg)] for deg in range(0, 20, 2)]
+	angle_data.append([20, coarse, coarse / 1000])
+
+	data_io.write_angle_spec_to_file(angle_data, '0.5M_DPPA_in_DMF', tmp_path)
+	df = pd.read_csv(tmp_path / '0.5M_DPPA_in_DMF_angle-resolved_spectra.csv', float_precision='round_trip')
+	assert list(df.columns) == ['Wavenumber (cm-1)'] + ['Int deg{} (arb)'.format(deg) for deg in range(0, 22, 2)]
+	np.testing.assert_array_equal(df['Wavenumber (cm-1)'], wavenumbers)
+	np.testing.assert_array_equal(df['Int deg6 (arb)'], angle_data[3][2])
+	np.testing.assert_allclose(df['Int deg20 (arb)'], wavenumbers / 1000)
+
+	# Values are written in their shortest form, e.g. 0.1 and not 0.10000000000000001
+	data_io.write_angle_spec_to_file([[0, [500.0, 500.5], [0.1, 0.25]]], 'short', tmp_path)
+	lines = (tmp_path / 'short_angle-resolved_spectra.csv').read_text().splitlines()
+	assert lines[1:] == ['500.0,0.1', '500.5,0.25']
@@ -0,0 +1,104 @@
+#!/usr/bin/env python
+"""
+Name: test_pmath
+Description: Polariton peak positions for every angle of an angle-resolved
+			 experiment are found by fitting two lineshapes to each spectrum.
+
+			 This method tests:
+
+			 1. Batch fitting recovers the lower and upper polariton peaks of
+			 	every angle, in order, whether the angles are fitted in this
+			 	process or split over a process pool.
+
+			 2. Starting from a guess made for one angle in the middle of a
+			 	strongly dispersing data set, every block of angles is warm
+			 	started outward from that angle and finds the right peaks,
+			 	where fitting each angle from the guess does not.
+
+			 3. Where the peaks move too far between the first angles of
+			 	neighbouring blocks for a block to be started from the
+			 	previous one, each block is still fitted from the angle
+			 	next to it.
+"""
+
+import numpy as np
+import pmath
+
+
+def polariton_spectra(angles, wavenumbers, E0=2170.0, Rabi=30.0, n_eff=1.8, lineshape=pmath.lorentzian,
+					  widths=(6.0, 8.0)):
+	"""Two peaks (Lorentzian by default) following the coupled cavity-vibration dispersion."""
+	theta = np.deg2rad(angles)
+	LP = pmath.coupled_energies(theta, E0, 2165.0, Rabi, n_eff, branch=0)
+	UP = pmath.coupled_energies(theta, E0, 2165.0, Rabi, n_eff, branch=1)
+	intensities = np.array([lineshape(wavenumbers, 50.0, lp, widths[0]) + lineshape(wavenumbers, 40.0, up, widths[1])
+		for lp, up in zip(LP, UP)])
+	return LP, UP, intensities
+
+
+def test_fit_polariton_peaks():
+	"""
+	Fit upper and lower polariton peaks for every angle.
+	"""
+	angles = np.arange(0, 22, 2)
+	wavenumbers = np.linspace(2000, 2400, 801)
+	LP, UP, intensities = polariton_spectra(angles, wavenumbers)
+
+	# Guess with the peaks swapped: the table still lists the lower one first
+	guess = [40.0, 2190.0, 5.0, 50.0, 2140.0, 5.0]
+	for workers in [1, 3]:
+		table = pmath.fit_polariton_peaks(angles, wavenumbers, intensities, guess, lineshape=pmath.lorentzian,
+										  x_range=(2050, 2350), workers=workers)
+		assert table.dtype.names == ('angle', 'LP_amp', 'LP_w_0', 'LP_fwhm', 'UP_amp', 'UP_w_0', 'UP_fwhm', 'success')
+		assert table['success'].all()
+		np.testing.assert_array_equal(table['angle'], angles)
+		np.testing.assert_allclose(table['LP_w_0'], LP, rtol=1e-6)
+		np.testing.assert_allclose(table['UP_w_0'], UP, rtol=1e-6)
+		np.testing.assert_allclose(table['LP_fwhm'], 6.0, rtol=1e-4)
+
+
+def test_warm_start_from_seed():
+	"""
+	Fit a wide dispersion from a guess made for the middle angle.
+	"""
+	angles = np.linspace(0, 40, 65)
+	wavenumbers = np.linspace(1800, 3000, 2401)
+	LP, UP, intensities = polariton_spectra(angles, wavenumbers, E0=2100.0, Rabi=60.0, n_eff=1.2)
+	seed = 32
+	guess = [45.0, LP[seed] + 3, 5.0, 45.0, UP[seed] - 3, 7.0]
+
+	cold = [pmath.fit_peak_block(wavenumbers[None], intensities[[i]], guess, pmath.lorentzian, (-np.inf, np.inf), 10000)
+		for i in range(len(angles))]
+	cold_centers = np.sort([params[0][[1, 4]] for params, success in cold], axis=1)
+	assert not np.allclose(cold_centers, np.column_stack((LP, UP)), atol=0.1)
+
+	table = pmath.fit_polariton_peaks(angles, wavenumbers, intensities, guess, lineshape=pmath.lorentzian,
+									  workers=8, seed=seed)
+	assert table['success'].all()
+	np.testing.assert_allclose(table['LP_w_0'], LP, atol=1e-6)
+	np.testing.assert_allclose(table['UP_w_0'], UP, atol=1e-6)
+
+
+def test_warm_start_from_neighbour():
+	"""
+	Fit narrow Gaussian peaks that move several widths between block starts.
+	"""
+	angles = np.linspace(0, 40, 49)
+	wavenumbers = np.linspace(1800, 3000, 2401)
+	widths = (3.0, 4.0)
+	LP, UP, intensities = polariton_spectra(angles, wavenumbers, E0=2100.0, Rabi=60.0, n_eff=1.2,
+											lineshape=pmath.gaussian, widths=widths)
+	solution = lambda i: [50.0, LP[i], widths[0], 40.0, UP[i], widths[1]]
+	fit_args = (pmath.gaussian, (-np.inf, np.inf), 10000)
+
+	# Angle 40 is only found from the solution for angle 39, not for angle 32
+	far, _ = pmath.fit_peak_block(wavenumbers[None], intensities[[40]], solution(40 - pmath.FIT_BLOCK_SIZE), *fit_args)
+	near, _ = pmath.fit_peak_block(wavenumbers[None], intensities[[40]], solution(39), *fit_args)
+	assert not np.allclose(np.sort(far[0, [1, 4]]), [LP[40], UP[40]], atol=0.1)
+	np.testing.assert_allclose(np.sort(near[0, [1, 4]]), [LP[40], UP[40]], atol=1e-6)
+
+	table = pmath.fit_polariton_peaks(angles, wavenumbers, intensities, solution(0), lineshape=pmath.gaussian,
+									  workers=4)
+	assert table['success'].all()
+	np.testing.assert_allclose(table['LP_w_0'], LP, atol=1e-6)
+	np.testing.assert_allclose(table['UP_w_0'], UP, atol=1e-6)
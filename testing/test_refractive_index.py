@@ -62,8 +62,8 @@ def test_interpolation(yaml_filename):
 	new_wl = wave.wavelengths
 
 	single_layer.make_new_data_points(new_wl)
-	new_ri = single_layer.refractive_index
-	new_ec = single_layer.extinction_coeff
+	new_ri = single_layer.complex_refractive.real
+	new_ec = single_layer.complex_refractive.imag
 	
 	# Plot original and generated data
 	fig, ax = plt.subplots()
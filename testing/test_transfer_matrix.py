@@ -0,0 +1,702 @@
+#!/usr/bin/env python
+"""
+Name: test_transfer_matrix
+Description: The vectorized transfer matrix engine must give the same
+			 transmittance and reflectance as the original per-wavelength
+			 calculation (build_matrix_list followed by a matrix product).
+
+			 This method tests:
+
+			 1. The (N, 2, 2) matrix stacks reproduce the per-wavelength
+			 	transfer matrices for an absorbing multi-layer device.
+
+			 2. The angle x wavelength grid gives the same result as one
+			 	angle at a time, however it is split into memory blocks.
+
+			 3. The analytic dynamical matrix inverses are exact inverses.
+
+			 4. At oblique incidence the refracted angle in each layer follows
+			 	Snell's law: a single interface reproduces the Fresnel
+			 	equations and a lossless slab conserves energy.
+
+			 5. Mixed waves give the s-wave and p-wave spectra in one pass.
+
+			 6. The scattering matrix engine agrees with the transfer matrix
+			 	engine and stays finite for thick, strongly absorbing layers.
+
+			 7. Incoherent layers add intensities instead of amplitudes.
+
+			 8. Layers store one complex index array and slicing a layer
+			 	shares that array instead of copying it.
+
+			 9. Refractive index csv files are parsed once and then served
+			 	from a binary cache.
+
+			 10. Resampled index arrays are shared between layers using the
+			 	 same material and wavelength grid.
+
+			 11. A sweep of one layer, reusing the rest of the device, matches
+			 	 computing every variant of the device from scratch.
+
+			 12. simulate returns the spectra as arrays on the angle x
+			 	 wavelength grid without writing any files.
+
+			 13. Results saved to a binary result file are read back
+			 	 memory-mapped and export the same csv files.
+
+			 14. Blocks streamed to the writer thread while the grid is
+			 	 computed end up in the result file, and errors raised by a
+			 	 calculation are passed back when the writer is closed.
+
+			 15. Layers attached from shared memory give the same spectra
+			 	 and read the shared block instead of a copy.
+
+			 16. Every scheduler fills the whole grid with the same spectra,
+			 	 split into balanced blocks.
+
+			 17. Remote workers connected over a socket compute the grid, and
+			 	 a block held by a worker that disconnects or stops
+			 	 answering is recomputed by another worker.
+
+			 18. Unchanged devices are served from the result cache, edited
+			 	 devices and index files miss it, and the least recently
+			 	 used results are evicted first.
+
+			 19. Widening the angle and wavelength ranges reuses the points
+			 	 already computed and only computes the new region.
+
+			 20. Field amplitudes reproduce the reflectance and
+			 	 transmittance, and |E(z)|^2 of an s-wave is continuous
+			 	 across every interface and stays finite through a thick
+			 	 absorbing layer.
+"""
+
+import glob
+import multiprocessing
+import os
+import shutil
+import socket
+import stat
+import threading
+import time
+import numpy as np
+import pytest
+import transfer_matrix as tmm
+import results
+import data.refractive_index_data
+
+
+def make_layer(material, thickness, wavelengths, n, K):
+	"""Make a layer with a linearly varying complex refractive index."""
+	layer = tmm.Layer(material, len(wavelengths), thickness=thickness)
+	layer.wavelengths = [wavelengths[0], wavelengths[-1]]
+	layer.refractive_index = list(n)
+	layer.extinction_coeff = list(K)
+	layer.make_new_data_points(wavelengths)
+	return layer
+
+
+def make_device(wavelengths):
+	"""Glass / gold / spacer / gold / glass Fabry-Perot cavity."""
+	return [
+		make_layer('SiO2', 0.0, wavelengths, (1.45, 1.40), (0.0, 0.0)),
+		make_layer('Au', 10e-9, wavelengths, (0.5, 8.0), (6.0, 60.0)),
+		make_layer('Spacer', 2e-6, wavelengths, (1.33, 1.30), (0.0, 0.05)),
+		make_layer('Au', 10e-9, wavelengths, (0.5, 8.0), (6.0, 60.0)),
+		make_layer('SiO2', 0.0, wavelengths, (1.45, 1.40), (0.0, 0.0)),
+	]
+
+
+def per_wavelength(wavelengths, theta, layers, wave_type):
+	"""Reference calculation, one wavelength at a time."""
+	T, R = [], []
+	for idx, lmbda in enumerate(wavelengths):
+		single = [layer[idx] for layer in layers]
+		M = tmm.matrix_product(tmm.build_matrix_list(lmbda, theta, single, wave_type))
+		T.append(tmm.find_transmittance(M).real)
+		R.append(tmm.find_reflectance(M).real)
+	return np.array(T), np.array(R)
+
+
+def test_matrix_stack():
+	wavelengths = np.linspace(1.0, 10.0, 200)
+	layers = make_device(wavelengths)
+	for wave_type in ['s-wave', 'p-wave']:
+		M = tmm.matrix_product(tmm.build_matrix_stack(wavelengths, 0.0, layers, wave_type))
+		T_ref, R_ref = per_wavelength(wavelengths, 0.0, layers, wave_type)
+		assert M.shape == (len(wavelengths), 2, 2)
+		np.testing.assert_allclose(tmm.find_transmittance(M).real, T_ref, atol=1e-10)
+		np.testing.assert_allclose(tmm.find_reflectance(M), R_ref, atol=1e-10)
+
+
+def test_angle_grid():
+	wavelengths = np.linspace(1.0, 10.0, 200)
+	layers = make_device(wavelengths)
+	angles = np.linspace(0.0, 30.0, 7)
+	# A tiny memory budget forces the grid to be split into several blocks
+	T, R, A = tmm.transfer_matrix_grid(angles, wavelengths, layers, 's-wave', max_memory=0.05)
+	assert T.shape == (len(angles), len(wavelengths))
+	for idx, angle in enumerate(angles):
+		theta = angle * np.pi / 180.0
+		M = tmm.matrix_product(tmm.build_matrix_stack(wavelengths, theta, layers, 's-wave'))
+		np.testing.assert_allclose(T[idx], tmm.find_transmittance(M).real, atol=1e-12)
+		np.testing.assert_allclose(R[idx], tmm.find_reflectance(M), atol=1e-12)
+	np.testing.assert_allclose(A, 1 - T - R)
+
+
+def test_dynamical_inverse():
+	n = np.array([1.0, 1.5 + 0.01j, 0.5 + 6.0j])
+	cos_theta = np.cos(0.4)
+	for wave_type in ['s-wave', 'p-wave']:
+		D, Dinv = tmm.dynamical_matrices(n, cos_theta, wave_type)
+		np.testing.assert_allclose(D @ Dinv, np.broadcast_to(np.eye(2), D.shape), atol=1e-12)
+
+
+def test_oblique_incidence():
+	wavelengths = np.linspace(2.0, 6.0, 50)
+	theta = 50 * np.pi / 180
+	air = make_layer('Air', 0.0, wavelengths, (1.0, 1.0), (0.0, 0.0))
+	glass = make_layer('Glass', 0.0, wavelengths, (1.5, 1.5), (0.0, 0.0))
+	slab = make_layer('Slab', 3e-6, wavelengths, (2.4, 2.4), (0.0, 0.0))
+
+	# Fresnel equations for an air/glass interface
+	cos_t = np.sqrt(1 - (np.sin(theta) / 1.5)**2)
+	cos_i = np.cos(theta)
+	r_s = (cos_i - 1.5*cos_t) / (cos_i + 1.5*cos_t)
+	r_p = (cos_t - 1.5*cos_i) / (cos_t + 1.5*cos_i)
+	for wave_type, r in [('s-wave', r_s), ('p-wave', r_p)]:
+		M = tmm.matrix_product(tmm.build_matrix_stack(wavelengths, theta, [air, glass], wave_type))
+		np.testing.assert_allclose(tmm.find_reflectance(M), abs(r)**2, atol=1e-12)
+		np.testing.assert_allclose(tmm.find_transmittance(M).real, 1 - abs(r)**2, atol=1e-12)
+
+		M = tmm.matrix_product(tmm.build_matrix_stack(wavelengths, theta, [air, slab, glass], wave_type))
+		T = tmm.find_transmittance(M).real
+		R = tmm.find_reflectance(M)
+		np.testing.assert_allclose(T + R, 1.0, atol=1e-12)
+
+
+def test_mixed_polarization():
+	wavelengths = np.linspace(1.0, 10.0, 100)
+	layers = make_device(wavelengths)
+	angles = [0.0, 20.0, 40.0]
+	T, R, A = tmm.transfer_matrix_grid(angles, wavelengths, layers, 'mixed')
+	assert T.shape == (2, len(angles), len(wavelengths))
+	for idx, wave_type in enumerate(tmm.POLARIZATIONS):
+		T_i, R_i, A_i = tmm.transfer_matrix_grid(angles, wavelengths, layers, wave_type)
+		np.testing.assert_allclose(T[idx], T_i, atol=1e-12)
+		np.testing.assert_allclose(R[idx], R_i, atol=1e-12)
+
+	header, columns = results.spectra_columns(T[:, 0], R[:, 0], A[:, 0], 'mixed')
+	assert header[:3] == ['Transmittance', 'Reflectance', 'Absorptance']
+	assert len(header) == len(columns) == 9
+	np.testing.assert_allclose(columns[0], 0.5*(T[0, 0] + T[1, 0]))
+
+	with pytest.raises(ValueError):
+		tmm.transfer_matrix_grid(angles, wavelengths, layers, 'circular')
+
+
+def test_scattering_engine():
+	wavelengths = np.linspace(1.0, 10.0, 200)
+	layers = make_device(wavelengths)
+	for wave_type in ['s-wave', 'p-wave', 'mixed']:
+		for theta in [0.0, 0.6]:
+			transfer = tmm.calculate_spectra(wavelengths, theta, layers, wave_type, 'transfer')
+			scattering = tmm.calculate_spectra(wavelengths, theta, layers, wave_type, 'scattering')
+			for a, b in zip(transfer, scattering):
+				np.testing.assert_allclose(a, b, atol=1e-10)
+
+	# 1 mm of a lossy liquid: exp(-i*phi) overflows in the transfer matrix
+	air = make_layer('Air', 0.0, wavelengths, (1.0, 1.0), (0.0, 0.0))
+	liquid = make_layer('Liquid', 1e-3, wavelengths, (1.5, 1.5), (0.5, 0.5))
+	with np.errstate(all='ignore'):
+		T, R, A = tmm.calculate_spectra(wavelengths, 0.0, [air, liquid, air], 's-wave', 'scattering')
+	r = (1.0 - (1.5 + 0.5j)) / (1.0 + (1.5 + 0.5j))
+	assert np.all(np.isfinite(T)) and np.all(np.isfinite(R))
+	np.testing.assert_allclose(T, 0.0, atol=1e-12)
+	np.testing.assert_allclose(R, abs(r)**2, atol=1e-12)
+
+	for spectra in [lambda engine: tmm.calculate_spectra(wavelengths, 0.0, layers, 's-wave', engine),
+					lambda engine: tmm.sweep_spectra(wavelengths, 0.0, layers, 2, [liquid], 's-wave', engine)]:
+		with pytest.raises(ValueError):
+			spectra('fourier')
+	with pytest.raises(ValueError):
+		tmm.simulate(dict(constant_device(), engine='fourier'), cache_dir=None)
+
+
+def test_incoherent_layer():
+	wavelengths = np.linspace(2.0, 6.0, 300)
+	air = make_layer('Air', 0.0, wavelengths, (1.0, 1.0), (0.0, 0.0))
+	window = make_layer('CaF2', 1e-3, wavelengths, (1.4, 1.4), (0.0, 0.0))
+	window.coherent = False
+
+	# Lossless window: multiple reflections summed in intensity
+	rho = ((1.4 - 1.0) / (1.4 + 1.0))**2
+	T, R, A = tmm.calculate_spectra(wavelengths, 0.0, [air, window, air], 's-wave')
+	np.testing.assert_allclose(R, 2*rho / (1 + rho), atol=1e-12)
+	np.testing.assert_allclose(T, (1 - rho) / (1 + rho), atol=1e-12)
+
+	# A coherent cavity on an incoherent window: light bouncing between the
+	# cavity and the back of the window adds up in intensity
+	layers = make_device(wavelengths)
+	window = make_layer('SiO2', 1e-3, wavelengths, (1.45, 1.40), (0.0, 0.0))
+	window.coherent = False
+	T, R, A = tmm.calculate_spectra(wavelengths, 0.0, layers[:-1] + [window, air], 'p-wave')
+	T_cav, R_cav, A_cav = tmm.calculate_spectra(wavelengths, 0.0, layers, 'p-wave')
+	R_back = tmm.calculate_spectra(wavelengths, 0.0, layers[::-1], 'p-wave')[1]
+	n_glass = np.linspace(1.45, 1.40, len(wavelengths))
+	rho = ((n_glass - 1.0) / (n_glass + 1.0))**2
+	np.testing.assert_allclose(T, T_cav * (1 - rho) / (1 - R_back*rho), atol=1e-10)
+
+
+def test_layer_array():
+	wavelengths = np.linspace(1.0, 10.0, 50)
+	layer = make_layer('Au', 10e-9, wavelengths, (0.5, 8.0), (6.0, 60.0))
+	assert layer.complex_refractive.dtype == np.complex128
+	assert layer.complex_refractive.shape == wavelengths.shape
+	np.testing.assert_allclose(layer.complex_refractive.imag, np.linspace(6.0, 60.0, 50))
+
+	part = layer[10:20]
+	assert np.shares_memory(part.complex_refractive, layer.complex_refractive)
+	assert part.complex_refractive[0] == layer.complex_refractive[10]
+	assert layer[3].complex_refractive == layer.complex_refractive[3]
+
+	constant = tmm.Layer('Absorber', len(wavelengths))
+	constant.refractive_index = 1.5
+	constant.extinction_coeff = 0.1
+	constant.make_new_data_points(wavelengths)
+	np.testing.assert_allclose(constant.complex_refractive, 1.5 + 0.1j)
+
+
+def test_material_store(tmp_path):
+	source = os.path.join(os.path.dirname(data.refractive_index_data.__file__), 'Au.csv')
+	csv_path = str(tmp_path / 'Au.csv')
+	shutil.copy(source, csv_path)
+	cache_dir = str(tmp_path / 'cache')
+
+	material = tmm.load_material(csv_path, cache_dir)
+	np.testing.assert_allclose(material, tmm.read_refractive_csv(csv_path))
+	assert tmm.load_material(csv_path, cache_dir) is material
+	assert len(os.listdir(cache_dir)) == 1
+
+	# A new process only finds the binary copy
+	tmm.material_store.clear()
+	cached = tmm.load_material(csv_path, cache_dir)
+	assert isinstance(cached, np.memmap)
+	np.testing.assert_array_equal(cached, material)
+
+	# Editing the file replaces its binary copy
+	with open(csv_path, 'a') as f:
+		f.write('\n21.0,49.0,105.0')
+	edited = tmm.load_material(csv_path, cache_dir)
+	assert edited.shape[1] == material.shape[1] + 1
+	assert os.listdir(cache_dir) == ['Au_{}.npy'.format(tmm.file_digest(csv_path))]
+
+
+def test_resample_cache(tmp_path, monkeypatch):
+	monkeypatch.setattr(tmm, 'MATERIAL_CACHE', str(tmp_path / 'cache'))
+	monkeypatch.setattr(tmm, 'material_store', {})
+	wavelengths = np.linspace(0.3, 2.0, 500)
+	layers = []
+	for thickness in [10e-9, 20e-9]:
+		layer = tmm.Layer('Au', len(wavelengths), thickness=thickness)
+		layer.get_data_from_csv('Au.csv')
+		layer.make_new_data_points(wavelengths)
+		layers.append(layer)
+	assert layers[0].complex_refractive is layers[1].complex_refractive
+
+	linear = layers[0].complex_refractive
+	for method in ['cubic', 'pchip']:
+		layers[0].make_new_data_points(wavelengths, method)
+		assert layers[0].complex_refractive is not linear
+		np.testing.assert_allclose(layers[0].complex_refractive, linear, rtol=0.05)
+	with pytest.raises(ValueError):
+		layers[0].make_new_data_points(wavelengths, 'nearest')
+	assert os.listdir(str(tmp_path / 'cache')) == ['Au_{}.npy'.format(tmm.file_digest(layers[0].source[0]))]
+
+
+def test_sweep():
+	wavelengths = np.linspace(1.0, 10.0, 100)
+	layers = make_device(wavelengths)
+	spacers = [make_layer('Spacer', d, wavelengths, (1.33, 1.30), (0.0, 0.05)) for d in [1e-6, 2e-6, 3e-6]]
+	mirrors = [make_layer('Au', d, wavelengths, (0.5, 8.0), (6.0, 60.0)) for d in [5e-9, 20e-9]]
+	exits = [make_layer('Exit', 0.0, wavelengths, (n, n), (0.0, 0.0)) for n in [1.0, 1.5]]
+
+	for engine in ['transfer', 'scattering']:
+		for wave_type in ['s-wave', 'mixed']:
+			for sweep_idx, variants in [(2, spacers), (1, mirrors), (4, exits), (0, exits)]:
+				swept = tmm.sweep_spectra(wavelengths, 0.3, layers, sweep_idx, variants, wave_type, engine)
+				for idx, variant in enumerate(variants):
+					device = layers[:sweep_idx] + [variant] + layers[sweep_idx+1:]
+					expected = tmm.calculate_spectra(wavelengths, 0.3, device, wave_type, engine)
+					for a, b in zip(swept, expected):
+						np.testing.assert_allclose(a[idx], b, atol=1e-10)
+
+
+def constant_device():
+	"""Device dictionary in the yaml format with constant index layers."""
+	def layer(material, thickness, n, K):
+		return {'material': material, 'thickness': thickness, 'wavelength': None,
+				'refractive_index': n, 'extinction_coeff': K}
+	return {
+		'num_points': 50, 'min_wavelength': 2.0, 'max_wavelength': 8.0,
+		'wave': {'theta_i': 0.0, 'theta_f': 30.0, 'num_angles': 4},
+		'layers': {
+			'layer0': layer('Glass', 0, 1.5, 0.0),
+			'layer1': layer('Metal', 20, 2.0, 10.0),
+			'layer2': layer('Air', 5000, 1.0, 0.0),
+			'layer3': layer('Metal', 20, 2.0, 10.0),
+			'layer4': layer('Glass', 0, 1.5, 0.0),
+		},
+	}
+
+
+def test_simulate(tmp_path):
+	device = constant_device()
+	result = tmm.simulate(device, cache_dir=None)
+	assert result.transmittance.shape == (2, 4, 50)
+	np.testing.assert_allclose(result.wavelengths, np.linspace(2.0, 8.0, 50))
+
+	_, layers, angles, wavelengths = tmm.load_device(device)
+	expected = tmm.transfer_matrix_grid(angles, wavelengths, layers, 'mixed')
+	for a, b in zip((result.transmittance, result.reflectance, result.absorptance), expected):
+		np.testing.assert_allclose(a, b)
+	T_s, R_s, A_s = result.polarization('s-wave')
+	np.testing.assert_allclose(T_s, expected[0][0])
+	idx = result.angle_index(20.0)
+	np.testing.assert_allclose(result.unpolarized()[0][idx], expected[0][:, idx].mean(axis=0))
+	assert not os.listdir(tmp_path)
+
+	result.write_csv(tmp_path)
+	assert len(os.listdir(tmp_path)) == 4
+	data = np.loadtxt(tmp_path / 'deg10.0_.csv', delimiter=',', skiprows=1)
+	np.testing.assert_allclose(data[:, 1], result.unpolarized()[0][1])
+
+	device['sweep'] = {'layer': 2, 'parameter': 'thickness', 'values': [4000, 5000]}
+	swept = tmm.simulate_sweep(device, 's-wave')
+	np.testing.assert_allclose(swept[1].transmittance, result.transmittance[0])
+	assert swept[0].config['sweep_value'] == 4000
+
+	# Sweep folders stay inside the simulation folder
+	assert tmm.sweep_folder('thickness', 0, 4000.0) == 'thickness_4000.0'
+	assert tmm.sweep_folder('refractive_filename', 1, 'metals/Au (Olmon).csv') == 'refractive_filename_1_Au__Olmon_'
+	assert tmm.sweep_folder('refractive_filename', 2, '../') == 'refractive_filename_2'
+
+
+def test_result_store(tmp_path):
+	result = tmm.simulate(constant_device(), cache_dir=None)
+	path = result.save(str(tmp_path / results.RESULT_FILE))
+	loaded = results.load_result(str(tmp_path))
+	assert isinstance(loaded.transmittance, np.memmap)
+	for a, b in zip(loaded.unpolarized(), result.unpolarized()):
+		np.testing.assert_array_equal(a, b)
+	np.testing.assert_array_equal(loaded.angles, result.angles)
+	assert loaded.config['num_points'] == 50
+
+	result.write_csv(str(tmp_path / 'direct'))
+	results.export_csv(path, str(tmp_path / 'export'))
+	for name in os.listdir(tmp_path / 'direct'):
+		with open(tmp_path / 'direct' / name) as a, open(tmp_path / 'export' / name) as b:
+			assert a.read() == b.read()
+
+	# Filling the grid one block at a time
+	T, R, A = result.polarization('p-wave')
+	store = results.ResultStore.create(str(tmp_path / 'p.tmm'), result.angles, result.wavelengths, 'p-wave')
+	store.write(1, slice(10, 30), T[1, 10:30], R[1, 10:30], A[1, 10:30])
+	assert store.mask.sum() == 20 and store.mask[1, 10:30].all()
+	store.write(slice(None), slice(None), T, R, A)
+	store.flush()
+	np.testing.assert_array_equal(results.load_result(str(tmp_path / 'p.tmm')).reflectance, R)
+
+
+def test_result_writer(tmp_path):
+	wavelengths = np.linspace(1.0, 10.0, 200)
+	angles = np.linspace(0.0, 40.0, 9)
+	layers = make_device(wavelengths)
+	store = results.ResultStore.create(str(tmp_path / 'grid.tmm'), angles, wavelengths, 'mixed')
+	writer = results.ResultWriter(store, max_pending=2)
+	writer.start()
+	spectra = tmm.transfer_matrix_grid(angles, wavelengths, layers, 'mixed', max_memory=0.05, writer=writer)
+	writer.close()
+	assert store.mask.all()
+	loaded = results.load_result(str(tmp_path / 'grid.tmm'))
+	for a, b in zip((loaded.transmittance, loaded.reflectance, loaded.absorptance), spectra):
+		np.testing.assert_allclose(a, b)
+
+	writer = results.ResultWriter(store)
+	writer.start()
+	writer.reserve()
+	writer.fail(ValueError("calculation failed"))
+	with pytest.raises(ValueError):
+		writer.close()
+
+
+def test_shared_device():
+	wavelengths = np.linspace(1.0, 10.0, 100)
+	layers = make_device(wavelengths)
+	layers[2].coherent = False
+	shm, shared_args = tmm.share_device(wavelengths, layers)
+	try:
+		tmm.attach_device(*shared_args)
+		shared_layers = tmm.worker_device['layers']
+		block = np.ndarray((shm.size,), dtype=np.uint8, buffer=tmm.worker_device['shm'].buf)
+		assert np.shares_memory(shared_layers[1].complex_refractive, block)
+		del block
+		assert not shared_layers[2].coherent
+		wl_slice = slice(20, 70)
+		for a, b in zip(tmm.shared_block([0.0, 30.0], wl_slice, 'mixed'),
+						tmm.transfer_matrix_grid([0.0, 30.0], wavelengths, layers, 'mixed')):
+			np.testing.assert_allclose(a, b[..., wl_slice])
+	finally:
+		tmm.worker_device['shm'].close()
+		tmm.worker_device.clear()
+		shm.close()
+		shm.unlink()
+
+
+def test_scheduler(tmp_path, monkeypatch):
+	wavelengths = np.linspace(1.0, 10.0, 301)
+	angles = np.array([15.0])
+	layers = make_device(wavelengths)
+	expected = tmm.transfer_matrix_grid(angles, wavelengths, layers, 's-wave')
+
+	chunks = tmm.grid_chunks(1, 301, 5, min_chunks=8)
+	assert len(chunks) == 8
+	sizes = [len(range(301)[w]) for a, w in chunks]
+	assert max(sizes) - min(sizes) <= 1
+
+	for scheduler in ['serial', 'thread', 'process']:
+		path = str(tmp_path / (scheduler + '.tmm'))
+		store = results.ResultStore.create(path, angles, wavelengths, 's-wave')
+		writer = results.ResultWriter(store)
+		writer.start()
+		tmm.scheduled_grid(angles, wavelengths, layers, 's-wave', writer, workers=2, scheduler=scheduler)
+		writer.close()
+		assert store.mask.all()
+		loaded = results.load_result(path)
+		np.testing.assert_allclose(loaded.transmittance, expected[0])
+		np.testing.assert_allclose(loaded.reflectance, expected[1])
+
+	with pytest.raises(ValueError):
+		tmm.scheduled_grid(angles, wavelengths, layers, 's-wave', writer, scheduler='cluster')
+
+	# An interrupted run still releases its shared memory block
+	class InterruptedWriter:
+		def __init__(self):
+			self.reserved = 0
+		def reserve(self):
+			self.reserved += 1
+			if self.reserved > 2:
+				raise KeyboardInterrupt
+		def put(self, *args):
+			pass
+		def fail(self, error):
+			pass
+
+	shared = []
+	share_device = tmm.share_device
+	def record_share_device(*args):
+		shared.append(share_device(*args))
+		return shared[-1]
+	monkeypatch.setattr(tmm, 'share_device', record_share_device)
+	with pytest.raises(KeyboardInterrupt):
+		tmm.scheduled_grid(angles, wavelengths, layers, 's-wave', InterruptedWriter(), workers=2, scheduler='process')
+	with pytest.raises(FileNotFoundError):
+		tmm.shared_memory.SharedMemory(name=shared[0][0].name)
+
+
+def test_remote_workers(tmp_path, monkeypatch):
+	key_file = str(tmp_path / 'key' / 'authkey')
+	monkeypatch.setattr(tmm, 'AUTHKEY_FILE', key_file)
+	monkeypatch.setattr(tmm, 'REMOTE_AUTHKEY', None)
+	monkeypatch.setattr(tmm, 'REMOTE_BLOCK_TIMEOUT', 1)
+	wavelengths = np.linspace(1.0, 10.0, 200)
+	angles = np.linspace(0.0, 40.0, 5)
+	layers = make_device(wavelengths)
+	expected = tmm.transfer_matrix_grid(angles, wavelengths, layers, 'mixed')
+	with socket.socket() as sock:
+		sock.bind(('localhost', 0))
+		address = 'localhost:{}'.format(sock.getsockname()[1])
+
+	processes = []
+	hung = []
+
+	def workers():
+		# A client with the wrong key, a worker that takes one block and
+		# leaves, one that takes a block and never answers, then two that
+		# finish the grid
+		while True:
+			try:
+				tmm.Client(tmm.parse_address(address), authkey=b'wrong key')
+			except ConnectionRefusedError:
+				time.sleep(0.1)
+				continue
+			except multiprocessing.AuthenticationError:
+				break
+		assert stat.S_IMODE(os.stat(key_file).st_mode) == 0o600
+		conn = tmm.Client(tmm.parse_address(address), authkey=tmm.worker_authkey())
+		conn.recv()
+		assert conn.recv()[0] == 'block'
+		conn.close()
+		hung.append(tmm.Client(tmm.parse_address(address), authkey=tmm.worker_authkey()))
+		hung[0].recv()
+		assert hung[0].recv()[0] == 'block'
+		for _ in range(2):
+			processes.append(multiprocessing.Process(target=tmm.run_worker, args=(address,)))
+			processes[-1].start()
+
+	threading.Thread(target=workers).start()
+	path = str(tmp_path / 'remote.tmm')
+	store = results.ResultStore.create(path, angles, wavelengths, 'mixed')
+	writer = results.ResultWriter(store)
+	writer.start()
+	tmm.scheduled_grid(angles, wavelengths, layers, 'mixed', writer, workers=2, scheduler='remote', address=address)
+	writer.close()
+	for process in processes:
+		process.join()
+	hung[0].close()
+	assert store.mask.all()
+	assert not os.path.exists(key_file)
+	loaded = results.load_result(path)
+	for a, b in zip((loaded.transmittance, loaded.reflectance, loaded.absorptance), expected):
+		np.testing.assert_allclose(a, b)
+
+	# Without any worker the coordinator gives up instead of waiting forever
+	chunks = tmm.grid_chunks(len(angles), len(wavelengths), len(layers))
+	with pytest.raises(RuntimeError):
+		tmm.coordinate_blocks(chunks, angles, wavelengths, layers, 'mixed', writer, address=address, idle_timeout=1)
+
+	# There is no fixed default key: workers need a coordinator's key file
+	# or an explicit key
+	with pytest.raises(ValueError):
+		tmm.worker_authkey()
+	assert tmm.worker_authkey('secret') == b'secret'
+	assert tmm.coordinator_authkey('secret') == (b'secret', None)
+
+
+def test_result_cache(tmp_path):
+	cache_dir = str(tmp_path / 'cache')
+	device = constant_device()
+	result = tmm.simulate(device, cache_dir=cache_dir)
+	assert len(os.listdir(cache_dir)) == 1
+	cached = tmm.simulate(device, cache_dir=cache_dir)
+	assert isinstance(cached.transmittance, np.memmap)
+	np.testing.assert_array_equal(cached.transmittance, result.transmittance)
+
+	_, layers, _, _ = tmm.load_device(device)
+	key = tmm.device_key(device, layers, 'mixed')
+	assert key != tmm.device_key(device, layers, 's-wave')
+	device['layers']['layer2']['thickness'] = 6000
+	assert tmm.device_key(device, layers, 'mixed') != key
+
+	# Index file contents are part of the key, not its name or time stamp
+	csv_path = tmp_path / 'index.csv'
+	csv_path.write_text("Wavelength, n, k\n1.0,1.5,0.0\n10.0,1.4,0.1\n")
+	layers[2].source = tmm.material_key(str(csv_path))
+	key = tmm.device_key(device, layers, 'mixed')
+	os.utime(csv_path, (0, 0))
+	layers[2].source = tmm.material_key(str(csv_path))
+	assert tmm.device_key(device, layers, 'mixed') == key
+	csv_path.write_text("Wavelength, n, k\n1.0,1.5,0.0\n10.0,1.4,0.2\n")
+	layers[2].source = tmm.material_key(str(csv_path))
+	assert tmm.device_key(device, layers, 'mixed') != key
+
+	# A cache directory that cannot be created is skipped
+	(tmp_path / 'file').write_text('')
+	unwritable = str(tmp_path / 'file' / 'cache')
+	for reuse in [False, True]:
+		uncached = tmm.simulate(device, cache_dir=unwritable, reuse=reuse)
+		assert uncached.transmittance.shape == result.transmittance.shape
+	assert results.cache_result(result, 'a', unwritable) is None
+
+	# Least recently used entries go first
+	lru_dir = str(tmp_path / 'lru')
+	size = os.path.getsize(results.cache_result(result, 'a', lru_dir))
+	for idx, name in enumerate(['a', 'b', 'c']):
+		os.utime(results.cache_result(result, name, lru_dir), (idx, idx))
+	results.cached_result('a', lru_dir)
+	results.cache_result(result, 'd', lru_dir, max_size=2.5*size / 2**20)
+	assert sorted(os.listdir(lru_dir)) == ['a.tmm', 'd.tmm']
+
+	# The command line links result files to and from the cache instead of
+	# copying them
+	device_yaml = str(tmp_path / 'device.yaml')
+	with open(device_yaml, 'w') as f:
+		tmm.yaml.dump(constant_device(), f)
+	output_dir = str(tmp_path / 'output')
+	for _ in range(3):
+		tmm.angle_resolved_multiprocess(device_yaml, output_dir, 's-wave', grid=True, cache_dir=cache_dir)
+	result_file, = glob.glob(os.path.join(output_dir, '*', results.RESULT_FILE))
+	cached_file, = [path for path in glob.glob(os.path.join(cache_dir, '*.tmm')) if os.path.samefile(path, result_file)]
+	assert not glob.glob(os.path.join(output_dir, '*', '*.tmp')) and not glob.glob(os.path.join(cache_dir, '*.tmp'))
+	assert os.stat(result_file).st_nlink == 2
+	assert results.cache_result(result_file, os.path.splitext(os.path.basename(cached_file))[0], cache_dir) == cached_file
+	assert os.stat(result_file).st_nlink == 2
+
+
+def test_incremental(tmp_path):
+	cache_dir = str(tmp_path / 'cache')
+	device = constant_device()
+	device['num_points'] = 61  # 0.1 um steps
+	tmm.simulate(device, 'p-wave', cache_dir=cache_dir)
+
+	device['max_wavelength'] = 10.0
+	device['num_points'] = 81
+	device['wave']['theta_f'] = 40.0
+	device['wave']['num_angles'] = 5
+	_, layers, angles, wavelengths = tmm.load_device(device)
+	family = tmm.family_key(device, layers, 'p-wave')
+	store = results.ResultStore.create(str(tmp_path / 'wide.tmm'), angles, wavelengths, 'p-wave', family=family)
+	assert results.merge_results(store, results.find_results(family, glob.glob(cache_dir + '/*.tmm'))) == 4*61
+	assert store.mask[:4, :61].all() and not store.mask[4].any() and not store.mask[:, 61:].any()
+	chunks = tmm.missing_chunks(np.array(store.mask), len(layers), min_chunks=4)
+	covered = np.array(store.mask, dtype=int)
+	for a_slice, wl_slice in chunks:
+		covered[a_slice, wl_slice] += 1
+	assert (covered == 1).all()
+
+	widened = tmm.simulate(device, 'p-wave', cache_dir=cache_dir, reuse=True)
+	assert len(os.listdir(cache_dir)) == 2
+	expected = tmm.simulate(device, 'p-wave', cache_dir=None)
+	for a, b in zip(widened.polarization('p-wave'), expected.polarization('p-wave')):
+		np.testing.assert_allclose(a, b)
+
+
+def test_field_profile():
+	wavelengths = np.linspace(1.0, 10.0, 50)
+	layers = make_device(wavelengths)
+	theta = 0.4
+	amplitudes, k_z = tmm.field_amplitudes(wavelengths, theta, layers, 's-wave')
+	T, R, A = tmm.calculate_spectra(wavelengths, theta, layers, 's-wave')
+	np.testing.assert_allclose(np.abs(amplitudes[0, :, 1])**2, R)
+	n_cos = tmm.refractive_indices(layers) * tmm.snell_cosines(wavelengths, theta, layers)
+	np.testing.assert_allclose(n_cos[-1].real / n_cos[0].real * np.abs(amplitudes[-1, :, 0])**2, T)
+
+	boundaries = tmm.layer_boundaries(layers)
+	left = tmm.field_profile(wavelengths, theta, layers, boundaries - 1e-14)
+	right = tmm.field_profile(wavelengths, theta, layers, boundaries + 1e-14)
+	np.testing.assert_allclose(left, right, rtol=1e-6)
+
+	z = np.linspace(-1e-6, 3e-6, 200)
+	mixed = tmm.field_profile(wavelengths, theta, layers, z, 'mixed')
+	assert mixed.shape == (2, 50, 200)
+	np.testing.assert_allclose(mixed[0], tmm.field_profile(wavelengths, theta, layers, z, 's-wave'))
+	np.testing.assert_allclose(mixed[1], tmm.field_profile(wavelengths, theta, layers, z, 'p-wave'))
+
+	# 1 mm of a lossy liquid: the field decays to zero instead of overflowing
+	air = make_layer('Air', 0.0, wavelengths, (1.0, 1.0), (0.0, 0.0))
+	glass = make_layer('Glass', 1e-6, wavelengths, (1.5, 1.5), (0.0, 0.0))
+	liquid = make_layer('Liquid', 1e-3, wavelengths, (1.5, 1.5), (0.5, 0.5))
+	thick = [air, glass, liquid, air]
+	for wave_type in ['s-wave', 'mixed']:
+		amplitudes, k_z = tmm.field_amplitudes(wavelengths, theta, thick, wave_type)
+		assert np.all(np.isfinite(amplitudes))
+		with np.errstate(all='ignore'):
+			T, R, A = tmm.calculate_spectra(wavelengths, theta, thick, wave_type, 'scattering')
+		np.testing.assert_allclose(np.abs(amplitudes[0, ..., 1])**2, R, atol=1e-12)
+		boundaries = tmm.layer_boundaries(thick)
+		z = np.concatenate(([-1e-6], boundaries - 1e-14, boundaries + 1e-14, [2e-6, 5e-4, 2e-3]))
+		profile = tmm.field_profile(wavelengths, theta, thick, z, wave_type)
+		assert np.all(np.isfinite(profile))
+		s_wave = profile[0] if wave_type == 'mixed' else profile  # The normal p-wave component is not continuous
+		np.testing.assert_allclose(s_wave[:, 1:4], s_wave[:, 4:7], rtol=1e-6, atol=1e-300)
+		np.testing.assert_allclose(profile[..., -2:], 0.0, atol=1e-12)
@@ -15,16 +15,27 @@ Yeh, Pochi. 2005. Optical Wave in Layered Media.
 import argparse
 import codecs
 import csv
+import functools
+import glob
+import hashlib
 import importlib.resources as pkg_resources
+import json
 import logging
 import os
 import pdb
+import queue
+import re
+import secrets
 import sys
+import threading
 import time
 from itertools import tee
 import matplotlib.pyplot as plt
 import matplotlib.gridspec as gridspec
 import multiprocessing
+import multiprocessing.pool
+from multiprocessing import shared_memory
+from multiprocessing.connection import Client, Listener
 import numpy as np
 from ruamel_yaml import YAML
 import scipy as sp
@@ -38,6 +49,29 @@ yaml = YAML()
 # FORMATTER = logging.Formatter("%(asctime)s — %(name)s — %(levelname)s - %(message)s")
 FORMATTER = logging.Formatter("%(message)s")
 LOG_FILE = 'transfer_matrix.log'
+MAX_MEMORY = 512  # Memory budget (MB) for each block of an angle x wavelength grid calculation
+POLARIZATIONS = results.POLARIZATIONS  # Order of the polarization axis for mixed waves
+ENGINES = ['transfer', 'scattering']  # Choices for the 'engine' key in device yaml files
+USER_CACHE = results.USER_CACHE  # Per-user cache folder
+MATERIAL_CACHE = os.path.join(USER_CACHE, 'materials')  # Binary copies of refractive index files
+material_store = {}  # Refractive index data loaded in this process, shared by all layers
+file_digests = {}  # sha1 of each index file read, keyed by material_key
+CACHE_VERSION = 1  # Part of every result cache key; bump when a change alters computed spectra
+GRID_KEYS = ['num_points', 'min_wavelength', 'max_wavelength']  # Device keys setting the wavelength grid
+WAVE_GRID_KEYS = ['theta_i', 'theta_f', 'num_angles']  # 'wave' keys setting the angle grid
+INTERPOLATION = ['linear', 'cubic', 'pchip']  # Choices for the 'interpolation' key in device yaml files
+RESAMPLE_CACHE_SIZE = 128  # Number of (material, wavelength grid, method) entries kept by resample_index
+resample_cache = {}
+worker_device = {}  # Wavelengths and layers attached from shared memory in pool processes
+SCHEDULERS = ['process', 'thread', 'serial', 'remote']  # How scheduled_grid spreads blocks over workers
+CHUNK_MEMORY = 8  # Memory (MB) for the matrix stacks of one scheduled block, small enough to stay in cache
+CHUNKS_PER_WORKER = 4  # Minimum number of scheduled blocks per worker, for load balancing
+REMOTE_ADDRESS = 'localhost:6000'  # Coordinator address for the 'remote' scheduler and remote workers
+REMOTE_AUTHKEY = os.environ.get('PISTACHIO_AUTHKEY')  # Shared secret for the coordinator and remote workers
+AUTHKEY_FILE = os.path.join(USER_CACHE, 'authkey')  # Key made by a coordinator when PISTACHIO_AUTHKEY is not set
+REMOTE_IDLE_TIMEOUT = 600  # Seconds the coordinator waits without any connected worker before failing
+REMOTE_BLOCK_TIMEOUT = 300  # Seconds a remote worker has to return a block before it is given to another worker
+WORKER_CONNECT_TIMEOUT = 60  # Seconds a remote worker keeps trying to reach the coordinator
 
 class Wave:
 	"""
@@ -68,15 +102,27 @@ class Layer:
 	"""
 	Contains information and functions related to a single material layer in
 	a multi-layer device.
+
+	wavelengths, refractive_index and extinction_coeff hold the tabulated
+	data (or a constant index). After make_new_data_points, the complex
+	refractive index is one contiguous complex128 array aligned with
+	Wave.wavelengths. Indexing a layer with an int or slice (layer[i],
+	layer[a:b]) gives a layer restricted to those wavelengths, sharing the
+	index data without copying it.
 	"""
+	__slots__ = ('material', 'thickness', 'num_points', 'wavelengths', 'refractive_index',
+				 'extinction_coeff', 'complex_refractive', 'coherent', 'source')
+
 	def __init__(self, material, num_points, min_wl=0.0, max_wl=0.0, thickness=0.0):
 		self.material = material			# Material name string
 		self.thickness = thickness			# Layer thickness (be consistent, but test files are in nm)
 		self.num_points = num_points		# Number of wavelengths to scan through
-		self.wavelengths = []  				# wavelengths from refractive index data. Used only for testing.
+		self.wavelengths = []  				# wavelengths from refractive index data
 		self.refractive_index = [] 			# Array of refractive indices (real part)
 		self.extinction_coeff = []  		# Array of extinction coefficients (imaginary part)
-		self.complex_refractive = {}  		# Needs to be curly braces
+		self.complex_refractive = None  	# complex128 array, one value per simulation wavelength
+		self.coherent = True				# False for thick layers treated with intensities (no interference)
+		self.source = None					# Identifies the index data file for resample_index caching
 
 	def __repr__(self):
 		a = "{} \n".format(self.material)
@@ -84,36 +130,40 @@ class Layer:
 		c = "wavelengths: {}\n".format(self.wavelengths)
 		d = "refractive index: {}\n".format(self.refractive_index)
 		e = "extinction coefficient: {}\n".format(self.extinction_coeff)
-		return a+b+c+d+e
+		f = "coherent: {}\n".format(self.coherent)
+		return a+b+c+d+e+f
+
+	def __getitem__(self, index):
+		"""Layer restricted to the simulation wavelengths selected by index.
+		   The refractive index arrays are views into this layer's data."""
+		layer = Layer(self.material, self.num_points, thickness=self.thickness)
+		layer.wavelengths = self.wavelengths
+		layer.refractive_index = self.refractive_index
+		layer.extinction_coeff = self.extinction_coeff
+		layer.coherent = self.coherent
+		layer.source = self.source
+		layer.complex_refractive = self.complex_refractive[index]
+		return layer
 
 	def get_data_from_csv(self, refractive_filename):
 		"""
 		Extract refractive index data from file downloaded from refractiveindex.info. 
 		This site uses micrometers for wavelength units.
+		The file is only parsed once, see load_material.
 		"""
 
 		with pkg_resources.path(data.refractive_index_data, refractive_filename) as params:
 			# pkg_resources will return a path, which includes the csv file we want to read
 			params = os.path.abspath(params)
-			with open(params, 'r', encoding='utf-8') as csv_file:
-				csvreader = csv.reader(csv_file)
-				next(csvreader, None)
-				for row in csvreader:
-					wl = float(row[0])
-					n = float(row[1])
-					self.wavelengths.append(wl)
-					self.refractive_index.append(n)
-					try:
-						K = float(row[2])
-						self.extinction_coeff.append(K)
-					except IndexError:
-						self.extinction_coeff.append(0.0)
+		self.wavelengths, self.refractive_index, self.extinction_coeff = load_material(params)
+		self.source = material_key(params)
 
 	def get_data_from_txt(self, index_path):
 		"""
 		Extract refractive index data from file downloaded from for filmetrics.com.
 		WARNING: Not tested in a long time. The format may have changed. Code may have changed.
 		"""
+		self.source = material_key(index_path)
 		with open(index_path, 'r') as params:
 			header = next(params)
 			unit = 1
@@ -133,34 +183,155 @@ class Layer:
 					K = float(line[2])
 					self.extinction_coeff.append(K)
 
-	def make_new_data_points(self, wavelengths):
+	def make_new_data_points(self, wavelengths, method='linear'):
 		"""
 		Makes new data points based on user-defined num_points and interpolation.
-		Input: list of wavelengths in micrometers generated from yaml config file.
-		Output: refractive index values (real and imaginary) mapped to wavelengths.
+		Input: list of wavelengths in micrometers generated from yaml config file,
+			   interpolation method (see resample_index).
+		Output: complex refractive index mapped to wavelengths, stored in
+				complex_refractive. The tabulated data is left unchanged.
 		"""
 		
-		if not isinstance(self.refractive_index, list):
-			self.refractive_index = [self.refractive_index]*self.num_points
-			self.extinction_coeff = [self.extinction_coeff]*self.num_points
-			for idx, lmbda in enumerate(wavelengths):
-				self.complex_refractive[lmbda] = self.refractive_index[idx] + self.extinction_coeff[idx]
-
-		elif isinstance(self.refractive_index, list):
-			new_n = sp.interpolate.interp1d(self.wavelengths, self.refractive_index, fill_value='extrapolate')
-			new_K = sp.interpolate.interp1d(self.wavelengths, self.extinction_coeff, fill_value='extrapolate')
-			self.refractive_index = new_n(wavelengths)
-			self.extinction_coeff = new_K(wavelengths)
-			for idx, lmbda in enumerate(wavelengths):
-				self.complex_refractive[lmbda] = self.refractive_index[idx] + 1j*self.extinction_coeff[idx]
+		if np.ndim(self.refractive_index) == 0:
+			num_points = len(wavelengths)
+			self.complex_refractive = np.empty(num_points, dtype=np.complex128)
+			self.complex_refractive.real = float(self.refractive_index)
+			self.complex_refractive.imag = float(self.extinction_coeff)
+
+		else:
+			self.complex_refractive = resample_index(wavelengths, self.wavelengths, self.refractive_index,
+													 self.extinction_coeff, method, self.source)
 
 	def get_wavenumber(self, n, omega, theta=0):
-		"""Outputs the wavenumbers for the dielectric for the given
+		"""Outputs the wavenumber normal to the layer for the given
 		   angular frequency and angle"""
 
 		k_x = n*omega/sc.c * np.cos(theta)
-		k_z = n*omega/sc.c * np.sin(theta)
-		return k_x, k_z
+		return k_x
+
+
+def material_key(index_path):
+	"""Identifies the current contents of a refractive index file by path,
+	   modification time and size."""
+	stat = os.stat(index_path)
+	return (os.path.abspath(index_path), stat.st_mtime_ns, stat.st_size)
+
+
+def file_digest(path):
+	"""sha1 hash of a file's contents. Hashes are remembered per material_key,
+	   so each file is only read again after it changes."""
+	key = material_key(path)
+	if key not in file_digests:
+		with open(path, 'rb') as f:
+			file_digests[key] = hashlib.sha1(f.read()).hexdigest()
+	return file_digests[key]
+
+
+def read_refractive_csv(csv_path):
+	"""
+	Parse a refractiveindex.info csv file.
+	Output: (3, N) array of wavelength (um), refractive index and extinction
+			coefficient. Files without an extinction column get zeros.
+	"""
+	rows = []
+	with open(csv_path, 'r', encoding='utf-8') as csv_file:
+		csvreader = csv.reader(csv_file)
+		next(csvreader, None)
+		for row in csvreader:
+			wl = float(row[0])
+			n = float(row[1])
+			try:
+				K = float(row[2])
+			except IndexError:
+				K = 0.0
+			rows.append((wl, n, K))
+	return np.array(rows).T
+
+
+def load_material(csv_path, cache_dir=None):
+	"""
+	Refractive index data from a refractiveindex.info csv file as a read-only
+	(3, N) array of wavelength, refractive index and extinction coefficient.
+
+	The csv file is only parsed the first time it is seen. Its data is saved
+	in cache_dir (default MATERIAL_CACHE) as a .npy file named after a hash
+	of the csv contents and is memory-mapped on later runs; copies of
+	earlier contents of a file with the same name are removed. Within one process every layer using the
+	same file shares a single array from material_store.
+	"""
+	key = material_key(csv_path)
+	if key in material_store:
+		return material_store[key]
+
+	cache_dir = cache_dir or MATERIAL_CACHE
+	digest = file_digest(csv_path)
+	name = os.path.splitext(os.path.basename(csv_path))[0]
+	npy_path = os.path.join(cache_dir, '{}_{}.npy'.format(name, digest))
+
+	if os.path.exists(npy_path):
+		material = np.load(npy_path, mmap_mode='r')
+	else:
+		material = read_refractive_csv(csv_path)
+		material.flags.writeable = False
+		try:
+			os.makedirs(cache_dir, exist_ok=True)
+			copy = re.compile(re.escape(name) + r'_[0-9a-f]{40}\.npy')
+			stale = [path for path in glob.glob(os.path.join(cache_dir, glob.escape(name) + '_*.npy'))
+				if copy.fullmatch(os.path.basename(path))]
+			tmp_path = npy_path + '.{}.tmp'.format(os.getpid())
+			with open(tmp_path, 'wb') as f:
+				np.save(f, material)
+			os.replace(tmp_path, npy_path)
+			for old_path in stale:
+				os.remove(old_path)
+		except OSError:
+			pass  # Read-only cache directory; parse the csv again next run
+
+	material_store[key] = material
+	return material
+
+
+def resample_index(wavelengths, data_wavelengths, n, K, method='linear', source=None):
+	"""
+	Interpolate tabulated refractive index data onto the simulation wavelengths.
+	method is 'linear' (extrapolates linearly beyond the data), 'cubic'
+	(cubic spline) or 'pchip' (monotone cubic, does not overshoot next to
+	sharp absorption bands). Other methods raise ValueError.
+	Output: read-only complex128 array with one value per wavelength.
+
+	When source identifies the data (see material_key), the result is cached
+	per (source, wavelength grid, method), so layers and repeated runs that
+	use the same material on the same grid share one array.
+	"""
+	wavelengths = np.asarray(wavelengths, dtype=float)
+	key = None
+	if source is not None:
+		grid = hashlib.sha1(wavelengths.tobytes()).hexdigest()
+		key = (source, grid, method)
+		if key in resample_cache:
+			return resample_cache[key]
+
+	data = np.stack((np.asarray(n, dtype=float), np.asarray(K, dtype=float)))
+	if method == 'linear':
+		interpolator = sp.interpolate.interp1d(data_wavelengths, data, fill_value='extrapolate')
+	elif method == 'cubic':
+		interpolator = sp.interpolate.CubicSpline(data_wavelengths, data, axis=1)
+	elif method == 'pchip':
+		interpolator = sp.interpolate.PchipInterpolator(data_wavelengths, data, axis=1)
+	else:
+		raise ValueError("Unknown interpolation '{}'. Choose one of {}.".format(method, INTERPOLATION))
+
+	new_n, new_K = interpolator(wavelengths)
+	index = np.empty(len(wavelengths), dtype=np.complex128)
+	index.real = new_n
+	index.imag = new_K
+	index.flags.writeable = False
+
+	if key is not None:
+		if len(resample_cache) >= RESAMPLE_CACHE_SIZE:
+			resample_cache.pop(next(iter(resample_cache)))
+		resample_cache[key] = index
+	return index
 
 
 def get_dict_from_yaml(yaml_file):
@@ -201,30 +372,90 @@ def get_layers_from_yaml(device_dict):
 	for i in range(num_layers):
 
 		layer_str = 'layer' + str(i)
-		layer = device_dict['layers'][layer_str]
-		material = layer['material']
-		thickness = float(layer['thickness']) * 10**-9
-		layer_class = Layer(material, num_points, min_wl, max_wl, thickness)
-
-		if "refractive_filename" in layer:
-			params = layer['refractive_filename']
-			if 'txt' in params:
-				layer_class.get_data_from_txt(params)
-			elif 'csv' in params:
-				layer_class.get_data_from_csv(params)
-		elif "refractive_index" in layer:
-			layer_class.refractive_index = layer['refractive_index']
-			layer_class.extinction_coeff = layer['extinction_coeff']
-			layer_class.wavelengths = layer['wavelength']
-		else:
-			print("ERROR: Incorrect yaml config format. Reference default template.")
-
+		layer_class = get_layer_from_dict(device_dict['layers'][layer_str], num_points, min_wl, max_wl)
 		layers.append(layer_class)
 		print(str(layer_class.material) + ", d=" + str(int(layer_class.thickness*10**9)) + "nm")
 	print('_'*50)
 	return layers
 
 
+def get_layer_from_dict(layer, num_points, min_wl=0.0, max_wl=0.0):
+	"""
+	Input: dictionary for a single layer from the yaml config file.
+	Output: Layer class with the refractive index data loaded.
+	"""
+	material = layer['material']
+	thickness = float(layer['thickness']) * 10**-9
+	layer_class = Layer(material, num_points, min_wl, max_wl, thickness)
+
+	if "refractive_filename" in layer:
+		params = layer['refractive_filename']
+		if 'txt' in params:
+			layer_class.get_data_from_txt(params)
+		elif 'csv' in params:
+			layer_class.get_data_from_csv(params)
+	elif "refractive_index" in layer:
+		layer_class.refractive_index = layer['refractive_index']
+		layer_class.extinction_coeff = layer['extinction_coeff']
+		layer_class.wavelengths = layer['wavelength']
+	else:
+		print("ERROR: Incorrect yaml config format. Reference default template.")
+
+	if "coherent" in layer:
+		layer_class.coherent = bool(layer['coherent'])
+
+	return layer_class
+
+
+def get_sweep_from_yaml(device_dict):
+	"""
+	Reads the optional sweep section of a device yaml file, e.g.
+
+	sweep:
+		layer: 2                # layer number (or 'layer2') to vary
+		parameter: thickness    # any layer key: thickness, refractive_index,
+								# extinction_coeff, refractive_filename, ...
+		values: [9000, 10000]   # or start, stop and num for a linear grid
+
+	Output: layer number, parameter name and list of values, or None if the
+			device has no sweep section.
+	"""
+	if 'sweep' not in device_dict:
+		return None
+
+	sweep = device_dict['sweep']
+	layer_num = int(str(sweep['layer']).replace('layer', ''))
+	parameter = sweep['parameter']
+	if 'values' in sweep:
+		values = list(sweep['values'])
+	else:
+		values = [float(v) for v in np.linspace(float(sweep['start']), float(sweep['stop']), int(sweep['num']))]
+	print("Sweep layer{} {} through {} values".format(layer_num, parameter, len(values)))
+	return layer_num, parameter, values
+
+
+def make_sweep_layers(device_dict, layer_num, parameter, values, wavelengths, interpolation='linear'):
+	"""
+	Makes one Layer for each value of the swept parameter, starting from the
+	yaml config of the swept layer. Index data is resampled onto wavelengths.
+	"""
+	layer_dict = dict(device_dict['layers']['layer' + str(layer_num)])
+	num_points = int(device_dict['num_points'])
+	if parameter in ('refractive_index', 'extinction_coeff'):
+		layer_dict.pop('refractive_filename', None)
+		layer_dict.setdefault('refractive_index', 1.0)
+		layer_dict.setdefault('extinction_coeff', 0.0)
+		layer_dict.setdefault('wavelength', None)
+
+	variants = []
+	for value in values:
+		layer_dict[parameter] = value
+		layer = get_layer_from_dict(layer_dict, num_points)
+		layer.make_new_data_points(wavelengths, interpolation)
+		variants.append(layer)
+	return variants
+
+
 def get_beam_profile(beam_csv):
 	"""Gets field distribution data from FTIR csv file.
 	   Outputs list of wavenumbers and field amplitudes.
@@ -262,41 +493,86 @@ def get_beam_profile(beam_csv):
 
 
 def propagation_matrix(wavenumber, layer_thickness):
-	"""Inputs: wave number, thickness of medium
+	"""Inputs: wave number (scalar or array), thickness of medium
 	   Output: propagation matrix (phase accumulation for plane wave
-				propagating through homogeneous medium)."""
-	phi = wavenumber*layer_thickness
-	P_i = np.array([[np.exp(-1j*phi), 0.0], [0.0, np.exp(1j*phi)]])
+				propagating through homogeneous medium).
+				For an array of wave numbers a stack of matrices with
+				shape (..., 2, 2) is returned."""
+	phase = np.exp(1j*np.asarray(wavenumber*layer_thickness))
+	P_i = np.zeros(phase.shape + (2, 2), dtype=complex)
+	P_i[..., 0, 0] = 1 / phase
+	P_i[..., 1, 1] = phase
 
 	return P_i
 
 
-def dynamical_matrix(n_, theta=0.0, wave_type='mixed'):
-	"""Inputs: index of refraction, angle of incidence
-		Outputs: dynamical matrices for s-wave and p-wave."""
+def dynamical_matrices(n_, cos_theta, wave_type):
+	"""Inputs: index of refraction and cosine of the angle in the layer
+			   (scalars or arrays), polarization.
+		Outputs: dynamical matrix and its inverse as (..., 2, 2) stacks.
+		For wave_type 'mixed' both polarizations are returned along a new
+		leading axis ordered as in POLARIZATIONS, giving (2, ..., 2, 2) stacks.
+		Other polarizations raise ValueError.
 
-	# s-wave dynamical matrix
-	m = n_ * np.cos(theta)
-	Ds = np.array([[1, 1], [m, -m]])
+		The inverses are written out analytically,
+			Ds^-1 = 1/2 [[1, 1/m], [1, -1/m]],  m = n*cos(theta)
+			Dp^-1 = 1/2 [[1/cos(theta), 1/n], [1/cos(theta), -1/n]]
+		so no general matrix inversion is needed."""
 
-	# p-wave dynamical matrix
-	Dp = np.array([[np.cos(theta), np.cos(theta)], [n_, -n_]])
+	if wave_type == 'mixed':
+		D_s, Dinv_s = dynamical_matrices(n_, cos_theta, 's-wave')
+		D_p, Dinv_p = dynamical_matrices(n_, cos_theta, 'p-wave')
+		return np.stack((D_s, D_p)), np.stack((Dinv_s, Dinv_p))
+
+	n_ = np.asarray(n_)
+	shape = np.broadcast(n_, cos_theta).shape + (2, 2)
+	D = np.zeros(shape, dtype=complex)
+	Dinv = np.zeros(shape, dtype=complex)
 
 	if wave_type == 's-wave':
-		return Ds
+		m = n_ * cos_theta
+		D[..., 0, 0] = 1
+		D[..., 0, 1] = 1
+		D[..., 1, 0] = m
+		D[..., 1, 1] = -m
+		Dinv[..., 0, 0] = 0.5
+		Dinv[..., 1, 0] = 0.5
+		Dinv[..., 0, 1] = 0.5 / m
+		Dinv[..., 1, 1] = -0.5 / m
+		return D, Dinv
 	elif wave_type == 'p-wave':
-		return Dp
-	elif wave_type == 'mixed':
-		pol_msg = "\nNo acceptable polarization passed in.\nMixed-wave not yet supported.\nSee --help for more info. Exiting...."
-		print(pol_msg)
-		sys.exit()
+		D[..., 0, 0] = cos_theta
+		D[..., 0, 1] = cos_theta
+		D[..., 1, 0] = n_
+		D[..., 1, 1] = -n_
+		Dinv[..., 0, 0] = 0.5 / cos_theta
+		Dinv[..., 1, 0] = 0.5 / cos_theta
+		Dinv[..., 0, 1] = 0.5 / n_
+		Dinv[..., 1, 1] = -0.5 / n_
+		return D, Dinv
+	else:
+		raise ValueError("Unknown polarization '{}'. Choose one of {} or 'mixed'.".format(wave_type, POLARIZATIONS))
+
+
+def dynamical_matrix(n_, theta=0.0, wave_type='mixed'):
+	"""Inputs: index of refraction (scalar or array), angle of incidence
+		Outputs: dynamical matrices for s-wave and p-wave.
+		For an array of indices a stack of matrices with shape (..., 2, 2)
+		is returned. 'mixed' returns both polarizations (see dynamical_matrices)."""
+
+	return dynamical_matrices(n_, np.cos(theta), wave_type)[0]
+
+
+def determinant(M_):
+    """Determinant of a 2x2 matrix or of every matrix in a (..., 2, 2) stack."""
+    return M_[..., 0, 0]*M_[..., 1, 1] - M_[..., 0, 1]*M_[..., 1, 0]
 
 
 def find_reflectance(M_):
-    """Input: multilayer matrix, M.
+    """Input: multilayer matrix, M, or a (..., 2, 2) stack of them.
        Output: Reflectance calculated from elements of transfer matrix."""
-    M21 = M_.item((1, 0))
-    M11 = M_.item((0, 0))
+    M21 = M_[..., 1, 0]
+    M11 = M_[..., 0, 0]
     r = M21 / M11
     r_sq = r * np.conj(r)
     r_sq = r_sq.real
@@ -307,35 +583,49 @@ def find_reflectance(M_):
 
 def find_transmittance(M_):
     """
-    Inputs: Multilayer matrix of dynamical matrices and propagation matrix.
+    Inputs: Multilayer matrix of dynamical matrices and propagation matrix,
+            or a (..., 2, 2) stack of them.
     Output: Transmittance calculated from elements of transfer matrix.
     """
-    M11 = M_.item((0, 0))
+    M11 = M_[..., 0, 0]
     t = 1/M11
     t_sq = t * np.conj(t)
     t_sq = t_sq.real
 
-    T = np.linalg.det(M_) * t_sq
+    T = determinant(M_) * t_sq
 
     return T
 
 
+def find_spectra(TM):
+	"""
+	Input: transfer matrix stack of any shape (..., 2, 2).
+	Output: transmittance, reflectance and absorptance arrays.
+	"""
+	transmittance = find_transmittance(TM).real
+	reflectance = find_reflectance(TM).real
+	absorptance = 1 - transmittance - reflectance
+	return transmittance, reflectance, absorptance
+
+
 def build_matrix_list(wavelength, theta, layers, wave_type):
 	"""
 	Makes a wavelength object and bounds. Outputs a list of matrices that will
 	make the transfer matrix for that wavelength of light propagating
-	through the device."""
+	through the device. Layers must be restricted to that wavelength,
+	e.g. [layer[idx] for layer in layers]."""
 
 	compute_wl = wavelength * 10**(-6)
 	omega = 2 * np.pi * sc.c / compute_wl
 	matrices = []
+	n0_sin = layers[0].complex_refractive * np.sin(theta)
 
 	for idx, layer in enumerate(layers):
 
-		n = layer.complex_refractive[wavelength]
-		kx = layer.get_wavenumber(n, omega, theta)[0]
-		D = dynamical_matrix(n, theta, wave_type)
-		Dinv = np.linalg.inv(D)
+		n = layer.complex_refractive
+		cos_theta = snell_cosine(n, n0_sin)
+		kx = n * omega / sc.c * cos_theta
+		D, Dinv = dynamical_matrices(n, cos_theta, wave_type)
 		P = propagation_matrix(kx, layer.thickness)
 
 		if idx == 0:
@@ -352,8 +642,114 @@ def build_matrix_list(wavelength, theta, layers, wave_type):
 	return matrices
 
 
+def refractive_indices(layers):
+	"""Complex refractive index of every layer as an array with shape
+	   (number of layers, number of wavelengths)."""
+	return np.stack([layer.complex_refractive for layer in layers])
+
+
+def snell_cosine(n_, n0_sin):
+	"""
+	Inputs: index of refraction of a layer and the conserved in-plane
+			quantity n_0*sin(theta_0) of the incident medium.
+	Output: complex cosine of the propagation angle in the layer.
+
+	From Snell's law n_j*cos(theta_j) = sqrt(n_j^2 - (n_0*sin(theta_0))^2).
+	The root with positive imaginary part is taken so that waves decay in
+	the direction of propagation in absorbing layers and beyond the
+	critical angle.
+	"""
+	n_cos = np.sqrt(np.asarray(n_*n_ - n0_sin*n0_sin, dtype=complex))
+	n_cos = np.where(n_cos.imag < 0, -n_cos, n_cos)
+	return n_cos / n_
+
+
+def snell_cosines(wavelengths, theta, layers):
+	"""
+	Complex cos(theta_j) for every layer, computed in one vectorized step
+	from the in-plane wavevector of the incident medium (see snell_cosine).
+	theta may be a scalar or an array that broadcasts against wavelengths,
+	e.g. shape (number of angles, 1).
+	Output: array with shape (number of layers,) + broadcast shape.
+	"""
+	wavelengths = np.asarray(wavelengths)
+	theta = np.asarray(theta, dtype=float)
+	n = refractive_indices(layers)
+	n0_sin = n[0] * np.sin(theta)
+	n = n.reshape((len(layers),) + (1,)*(n0_sin.ndim - 1) + (len(wavelengths),))
+	return snell_cosine(n, n0_sin)
+
+
+def layer_factors(wavelengths, theta, layers, wave_type):
+	"""
+	Precomputation stage for one angle. The dynamical matrix, its inverse and
+	the phase thickness phi = k*d of every layer are found once as arrays
+	over wavelength so they can be reused by the transfer matrix and
+	scattering matrix engines. The propagation angle in each layer follows
+	from Snell's law. For mixed waves D and Dinv have a leading polarization
+	axis, while the phase is shared by both polarizations.
+	Output: list of (D, Dinv, phi) tuples, one for each layer.
+	"""
+	wavelengths = np.asarray(wavelengths)
+	omega = 2 * np.pi * sc.c / (wavelengths * 10**(-6))
+	n = refractive_indices(layers)
+	cos_theta = snell_cosines(wavelengths, theta, layers)
+	factors = []
+
+	for layer, n_j, cos_j in zip(layers, n, cos_theta):
+		D, Dinv = dynamical_matrices(n_j, cos_j, wave_type)
+		phi = n_j * omega / sc.c * cos_j * layer.thickness
+		factors.append((D, Dinv, phi))
+
+	return factors
+
+
+def single_layer_factors(wavelengths, theta, layer, incident, wave_type):
+	"""
+	Same as layer_factors for one layer, given the incident medium (first
+	layer of the device). Used when only one layer of a device changes.
+	Output: (D, Dinv, phi) tuple.
+	"""
+	omega = 2 * np.pi * sc.c / (np.asarray(wavelengths) * 10**(-6))
+	n = layer.complex_refractive
+	cos_theta = snell_cosine(n, incident.complex_refractive * np.sin(theta))
+	D, Dinv = dynamical_matrices(n, cos_theta, wave_type)
+	phi = n * omega / sc.c * cos_theta * layer.thickness
+	return D, Dinv, phi
+
+
+def layer_matrices(wavelengths, theta, layers, wave_type):
+	"""
+	Dynamical matrix, its inverse and propagation matrix of every layer as
+	(N, 2, 2) stacks over wavelength (see layer_factors).
+	Output: list of (D, Dinv, P) tuples, one for each layer.
+	"""
+	factors = layer_factors(wavelengths, theta, layers, wave_type)
+	return [(D, Dinv, propagation_matrix(phi, 1.0)) for D, Dinv, phi in factors]
+
+
+def build_matrix_stack(wavelengths, theta, layers, wave_type):
+	"""
+	Vectorized version of build_matrix_list. Every matrix in the returned
+	list is a (N, 2, 2) stack with one 2x2 matrix per wavelength, so the
+	transfer matrix for all wavelengths is found with a few broadcasted
+	matrix products instead of a Python loop over wavelengths."""
+
+	factors = layer_matrices(wavelengths, theta, layers, wave_type)
+	matrices = [factors[0][1]]
+
+	for D, Dinv, P in factors[1:-1]:
+		matrices.append(D)
+		matrices.append(P)
+		matrices.append(Dinv)
+
+	matrices.append(factors[-1][0])
+	return matrices
+
+
 def matrix_product(matrices):
-	"""Product of matrices"""
+	"""Product of matrices. Stacks of matrices with shape (..., 2, 2)
+	   are multiplied element-wise along the leading axes."""
 
 	i = 0
 	M = np.array([[1,0], [0,1]])
@@ -362,119 +758,380 @@ def matrix_product(matrices):
 	return M
 
 
-def field_amp(matrix_list, A0_, B0_):
-	"""E_s = M*E_0
-		= D0inv * (Di_inv*P*Di)^n * D0  * E_0
-	Takes transfer matrix, final magnitude of EM wave, As, Bs.
-	Outputs E-field amplitude for given matrix. This approach starts calculations from
-	the incident wave."""
-
-	field_rev = []  #reversed order field amplitudes
-	E0 = np.array([A0_, B0_])
+def transfer_to_smatrix(M_):
+	"""
+	Input: transfer matrix stack (..., 2, 2) linking amplitudes on the left
+		   of a section to those on its right.
+	Output: scattering matrix stack [[r, t'], [t, r']] of the same section,
+			where r, t are for light incident from the left and r', t' for
+			light incident from the right.
+	"""
+	M11 = M_[..., 0, 0]
+	M12 = M_[..., 0, 1]
+	M21 = M_[..., 1, 0]
+	M22 = M_[..., 1, 1]
+	S = np.empty_like(M_)
+	S[..., 0, 0] = M21 / M11
+	S[..., 0, 1] = (M11*M22 - M12*M21) / M11
+	S[..., 1, 0] = 1 / M11
+	S[..., 1, 1] = -M12 / M11
+	return S
+
+
+def propagation_smatrix(phi):
+	"""
+	Input: phase thickness of a layer (scalar or array).
+	Output: scattering matrix of the layer. Only exp(+i*phi) appears, which
+			is bounded by 1 because Im(phi) >= 0, so thick absorbing layers
+			cannot overflow.
+	"""
+	phase = np.exp(1j*np.asarray(phi))
+	S = np.zeros(phase.shape + (2, 2), dtype=complex)
+	S[..., 0, 1] = phase
+	S[..., 1, 0] = phase
+	return S
 
-	i = len(matrix_list) - 1
-	slice_matrices = 3  # slice first three matrices from list after each dot product
 
-	M = matrix_product(matrix_list)
-	E_s = np.dot(M, E0)
-	field_rev.append(E_s)
-	matrix_list.pop(0)
+def redheffer_star(S_A, S_B):
+	"""
+	Redheffer star product of scattering matrix stacks, S_A on the left and
+	S_B on the right. Output: scattering matrix of the combined section.
+	"""
+	r_A, tp_A, t_A, rp_A = S_A[..., 0, 0], S_A[..., 0, 1], S_A[..., 1, 0], S_A[..., 1, 1]
+	r_B, tp_B, t_B, rp_B = S_B[..., 0, 0], S_B[..., 0, 1], S_B[..., 1, 0], S_B[..., 1, 1]
+	denom = 1 / (1 - rp_A*r_B)
 
-	while i != 1:
-		M_i = matrix_product(matrix_list)
-		E_i = np.dot(M_i, E0)
-		field_rev.append(E_i)
-		matrix_list = matrix_list[slice_matrices:]
-		i -= slice_matrices
+	S = np.empty(np.broadcast(S_A, S_B).shape, dtype=complex)
+	S[..., 0, 0] = r_A + tp_A * r_B * t_A * denom
+	S[..., 0, 1] = tp_A * tp_B * denom
+	S[..., 1, 0] = t_B * t_A * denom
+	S[..., 1, 1] = rp_B + t_B * rp_A * tp_B * denom
+	return S
 
-	if len(matrix_list) == 1:
-		E_i = np.dot(matrix_list[0], E0)
-		field_rev.append(E_i)
 
-	field = list(reversed(field_rev))
+def section_smatrix(factors, start, stop):
+	"""
+	Inputs: layer factors (see layer_factors), index of the first and last
+			layer of a section of the device.
+	Output: scattering matrix from the first to the last layer of the
+			section. Propagation through the first and last layers
+			themselves is not included.
+	"""
+	S = None
+	for idx in range(start, stop):
+		Dinv_j, phi_j = factors[idx][1:]
+		D_k = factors[idx+1][0]
+		S_interface = transfer_to_smatrix(np.matmul(Dinv_j, D_k))
+		if S is None:
+			S = S_interface
+		else:
+			S = redheffer_star(S, propagation_smatrix(phi_j))
+			S = redheffer_star(S, S_interface)
+	return S
 
-	return field
 
+def scattering_spectra(wavelengths, theta, layers, wave_type):
+	"""
+	Scattering matrix (S-matrix) engine. Interfaces and layers are combined
+	with Redheffer star products instead of multiplying transfer matrices,
+	so no growing exp(-i*phi) terms appear and results stay finite for
+	thick, strongly absorbing layers.
+	Output: transmittance, reflectance and absorptance arrays.
+	"""
+	factors = layer_factors(wavelengths, theta, layers, wave_type)
+	S = section_smatrix(factors, 0, len(factors)-1)
 
-def write_tmm_results(angle, output_dir, rows):
-	"""Writes transmission, reflectance, abosorbance data to csv file"""
+	# Same intensity factor as det(M) in find_transmittance
+	factor = determinant(factors[0][1]) * determinant(factors[-1][0])
 
-	wavelens, trans, refl, absor = rows
-	file_name = 'deg' + str(angle) + '_.csv'  # Underscore is to make it work with reading in angle in another method
-	output_file = os.path.join(output_dir, file_name)
+	r = S[..., 0, 0]
+	t = S[..., 1, 0]
+	transmittance = (factor * np.abs(t)**2).real
+	reflectance = np.abs(r)**2
+	absorptance = 1 - transmittance - reflectance
+	return transmittance, reflectance, absorptance
 
-	with open (output_file, 'w', encoding='utf8', newline='') as out_file:
 
-		filewriter = csv.writer(out_file, delimiter=',')
-		header = ['Wavelength',
-				  'Transmittance',
-				  'Reflectance',
-				  'Absorptance']
-		filewriter.writerow(header)
-		i = 0
-		while i < len(trans):
-			row = [wavelens[i], trans[i], refl[i], absor[i]]
-			filewriter.writerow(row)
-			i+=1
+def intensity_smatrix(S, factors, start, stop):
+	"""
+	Convert the amplitude scattering matrix of a coherent section into an
+	intensity matrix [[R, T'], [T, R']]. Intensity matrices combine with the
+	same Redheffer star product as amplitudes, but without any phase, which
+	is what an incoherent (thick) layer between two sections needs.
+	"""
+	factor = determinant(factors[start][1]) * determinant(factors[stop][0])
+	S_int = np.empty_like(S)
+	S_int[..., 0, 0] = np.abs(S[..., 0, 0])**2
+	S_int[..., 0, 1] = np.abs(S[..., 0, 1])**2 / factor
+	S_int[..., 1, 0] = np.abs(S[..., 1, 0])**2 * factor
+	S_int[..., 1, 1] = np.abs(S[..., 1, 1])**2
+	return S_int
 
 
-def output_field_profile(wavelens, layers, E_amps):
+def incoherent_spectra(wavelengths, theta, layers, wave_type):
 	"""
-	Take list of wavelengths
-	WARNING: Needs to be tested.
+	Spectra of a device containing incoherent layers (coherent: false in the
+	yaml config), such as mm-thick substrates and windows.
+	The device is split at every incoherent layer into coherent sections.
+	Each section is solved with scattering matrices, converted to an
+	intensity matrix and the sections are combined with intensities only,
+	attenuated by exp(-2*Im(phi)) across each incoherent layer. Interference
+	fringes from the incoherent layers are averaged out exactly, so they do
+	not need to be resolved with dense wavelength sampling.
+	Output: transmittance, reflectance and absorptance arrays.
 	"""
-	k = 0.2  # test wavenumber, 2000 cm^-1
-	a = E_amps[100]
-	layer_coords = []
-	for idx, layer in enumerate(layers):
-		if idx == 0:
-			layer_coords.append(0)
+	factors = layer_factors(wavelengths, theta, layers, wave_type)
+	last = len(layers) - 1
+	bounds = [0] + [idx for idx in range(1, last) if not layers[idx].coherent] + [last]
+
+	S = None
+	for start, stop in zip(bounds[:-1], bounds[1:]):
+		S_section = intensity_smatrix(section_smatrix(factors, start, stop), factors, start, stop)
+		if S is None:
+			S = S_section
 		else:
-			d = int(layer.thickness * 10**9)
-			x_i = layer_coords[idx-1] + d
-			layer_coords.append(x_i)
-
-	# Generate x-coordinates
-	num_pts = 10000
-	MAX = layer_coords[-1] + 0.1*layer_coords[-1]
-	LAST = len(layer_coords) - 1
-	x = []
-	profile = []
-	for idx, l in enumerate(layer_coords):
-		if idx == LAST:
-			domain = np.linspace(l, MAX, num_pts)
-			x.append(domain)
+			S_layer = np.abs(propagation_smatrix(factors[start][2]))**2
+			S = redheffer_star(S, S_layer)
+			S = redheffer_star(S, S_section)
+
+	transmittance = S[..., 1, 0].real
+	reflectance = S[..., 0, 0].real
+	absorptance = 1 - transmittance - reflectance
+	return transmittance, reflectance, absorptance
+
+
+def calculate_spectra(wavelengths, theta, layers, wave_type, engine='transfer'):
+	"""
+	Transmittance, reflectance and absorptance for one angle (or a column
+	of angles, see transfer_matrix_grid) with the chosen engine.
+	'transfer' multiplies transfer matrices, 'scattering' uses the
+	numerically stable S-matrix engine; other engines raise ValueError.
+	Devices with incoherent layers are always solved with incoherent_spectra.
+	"""
+	if not all(layer.coherent for layer in layers[1:-1]):
+		return incoherent_spectra(wavelengths, theta, layers, wave_type)
+	elif engine == 'transfer':
+		TM = matrix_product(build_matrix_stack(wavelengths, theta, layers, wave_type))
+		return find_spectra(TM)
+	elif engine == 'scattering':
+		return scattering_spectra(wavelengths, theta, layers, wave_type)
+	else:
+		raise ValueError("Unknown engine '{}'. Choose one of {}.".format(engine, ENGINES))
+
+
+def star_product(smatrices):
+	"""Redheffer star product of a list of scattering matrices, left to right.
+	   None entries stand for empty sections and are skipped."""
+	S = None
+	for S_i in smatrices:
+		if S_i is None:
+			continue
+		S = S_i if S is None else redheffer_star(S, S_i)
+	return S
+
+
+def sweep_spectra(wavelengths, theta, layers, sweep_idx, variants, wave_type, engine='transfer'):
+	"""
+	Spectra for a series of devices that differ only in one layer.
+	Inputs: wavelengths, angle(s), device layers, number of the swept layer,
+			list of Layer objects to put in its place, polarization, engine.
+	Outputs: transmittance, reflectance and absorptance with a leading axis
+			 over variants.
+
+	The parts of the device left and right of the swept layer do not change,
+	so their partial products (transfer matrices or scattering matrices) are
+	computed once and every variant only costs one layer. Sweeping the
+	incident medium changes the angle in every layer, and incoherent layers
+	need intensity matrices, so those devices are recomputed in full.
+	"""
+	last = len(layers) - 1
+	coherent = all(layer.coherent for layer in layers[1:-1] + variants)
+	if sweep_idx == 0 or not coherent:
+		spectra = [calculate_spectra(wavelengths, theta, layers[:sweep_idx] + [v] + layers[sweep_idx+1:],
+									 wave_type, engine) for v in variants]
+		return tuple(np.stack(s) for s in zip(*spectra))
+
+	factors = layer_factors(wavelengths, theta, layers, wave_type)
+	det_0 = determinant(factors[0][1])
+	spectra = []
+
+	if engine == 'transfer':
+		left = [factors[0][1]]
+		for D, Dinv, phi in factors[1:sweep_idx]:
+			left += [D, propagation_matrix(phi, 1.0), Dinv]
+		right = []
+		for D, Dinv, phi in factors[sweep_idx+1:last]:
+			right += [D, propagation_matrix(phi, 1.0), Dinv]
+		left = matrix_product(left)
+		right = matrix_product(right + [factors[last][0]])
+
+		for variant in variants:
+			D, Dinv, phi = single_layer_factors(wavelengths, theta, variant, layers[0], wave_type)
+			if sweep_idx == last:
+				TM = np.matmul(left, D)
+			else:
+				TM = matrix_product([left, D, propagation_matrix(phi, 1.0), Dinv, right])
+			spectra.append(find_spectra(TM))
+
+	elif engine == 'scattering':
+		# Everything up to (and including) propagation through the layer before the swept one
+		left = section_smatrix(factors, 0, sweep_idx-1)
+		if sweep_idx > 1:
+			left = redheffer_star(left, propagation_smatrix(factors[sweep_idx-1][2]))
+		right = None
+		if sweep_idx < last:
+			right = section_smatrix(factors, sweep_idx+1, last)
+			if sweep_idx+1 < last:
+				right = star_product([propagation_smatrix(factors[sweep_idx+1][2]), right])
+
+		Dinv_before = factors[sweep_idx-1][1]
+		for variant in variants:
+			D, Dinv, phi = single_layer_factors(wavelengths, theta, variant, layers[0], wave_type)
+			S_in = transfer_to_smatrix(np.matmul(Dinv_before, D))
+			if sweep_idx == last:
+				S = star_product([left, S_in])
+				factor = det_0 * determinant(D)
+			else:
+				S_out = transfer_to_smatrix(np.matmul(Dinv, factors[sweep_idx+1][0]))
+				S = star_product([left, S_in, propagation_smatrix(phi), S_out, right])
+				factor = det_0 * determinant(factors[last][0])
+			transmittance = (factor * np.abs(S[..., 1, 0])**2).real
+			reflectance = np.abs(S[..., 0, 0])**2
+			spectra.append((transmittance, reflectance, 1 - transmittance - reflectance))
+
+	else:
+		raise ValueError("Unknown engine '{}'. Choose one of {}.".format(engine, ENGINES))
+
+	return tuple(np.stack(s) for s in zip(*spectra))
+
+
+def layer_boundaries(layers):
+	"""Positions (m) of the interfaces of a device, starting at 0 for the
+	   interface between the first layer (incident medium) and the second."""
+	return np.concatenate(([0.0], np.cumsum([layer.thickness for layer in layers[1:-1]])))
+
+
+def field_amplitudes(wavelengths, theta, layers, wave_type):
+	"""
+	Forward (A) and backward (B) wave amplitudes in every layer for an
+	incident wave of unit amplitude, found in one pass from the last layer
+	back to the first:
+		(A, B)_j = P_j Dinv_j D_j+1 (A, B)_j+1,  (A, B)_last = (t, 0)
+	A is given at the left interface of each layer and B at the right
+	interface, where each wave enters the layer, so both only decay inside
+	absorbing layers. In the incident medium they are (1, r) at its right
+	interface. All layers are treated coherently.
+	The amplitudes grow by exp(Im(phi)) through each lossy layer on the way
+	back, so they are rescaled layer by layer and the scales are kept as
+	logarithms; thick absorbing layers give vanishing but finite fields.
+	Outputs: amplitudes with shape (number of layers, ..., number of
+			 wavelengths, 2), with a polarization axis after the layer axis
+			 for mixed waves, and the wavevector component normal to the
+			 layers with shape (number of layers, number of wavelengths).
+	"""
+	wavelengths = np.asarray(wavelengths)
+	n = refractive_indices(layers)
+	cos_theta = snell_cosines(wavelengths, theta, layers)
+	k_z = 2 * np.pi / (wavelengths * 10**(-6)) * n * cos_theta
+	D, Dinv = zip(*[dynamical_matrices(n_j, cos_j, wave_type) for n_j, cos_j in zip(n, cos_theta)])
+
+	amplitudes = np.zeros((len(layers),) + D[0].shape[:-1], dtype=complex)
+	log_scale = np.zeros((len(layers),) + D[0].shape[:-2])  # amplitudes[j] * exp(log_scale[j]) is unscaled
+	amplitudes[-1, ..., 0] = 1
+	left = amplitudes[-1]  # (A, B) at the left interface of layer j+1
+	for j in range(len(layers) - 2, -1, -1):
+		right = (Dinv[j] @ D[j+1] @ left[..., np.newaxis])[..., 0]
+		scale = log_scale[j+1]
+		if j == 0:
+			left = right
 		else:
-			domain = np.linspace(l, layer_coords[idx+1], num_pts)
-			x.append(domain)
+			# exp(-i*phi) and exp(i*phi) with the larger magnitude, exp(|Im(phi)|), taken out
+			phi = k_z[j] * layers[j].thickness
+			loss = np.abs(phi.imag)
+			left = np.empty_like(right)
+			left[..., 0] = np.exp(-1j*phi.real + phi.imag - loss) * right[..., 0]
+			left[..., 1] = np.exp(1j*phi.real - phi.imag - loss) * right[..., 1]
+			right = right * np.exp(-loss)[..., np.newaxis]
+			scale = scale + loss
+		norm = np.abs(left).max(axis=-1)[..., np.newaxis]
+		left = left / norm
+		amplitudes[j, ..., 0] = left[..., 0]
+		amplitudes[j, ..., 1] = right[..., 1] / norm[..., 0]
+		log_scale[j] = scale + np.log(norm[..., 0])
+
+	# Unit incident amplitude
+	amplitudes *= (np.exp(log_scale - log_scale[0]) / amplitudes[0, ..., 0])[..., np.newaxis]
+	return amplitudes, k_z
+
+
+def field_profile(wavelengths, theta, layers, z, wave_type='s-wave'):
+	"""
+	Electric field intensity |E(z)|^2, relative to the incident wave, at
+	positions z (m, see layer_boundaries) through the device for every
+	wavelength at once. Negative z is in the incident medium and z past the
+	last interface is in the last layer. For p-waves both the tangential
+	and normal field components are included.
+	Output: array with shape (number of wavelengths, number of z points),
+			with a leading polarization axis for mixed waves.
+	"""
+	z = np.asarray(z, dtype=float)
+	amplitudes, k_z = field_amplitudes(wavelengths, theta, layers, wave_type)
+	boundaries = layer_boundaries(layers)
+	idx = np.searchsorted(boundaries, z, side='right')  # layer containing each z
+	from_left = (z - boundaries[np.maximum(idx - 1, 0)])[:, np.newaxis]
+	from_right = (z - boundaries[np.minimum(idx, len(boundaries) - 1)])[:, np.newaxis]
+
+	A = np.moveaxis(amplitudes[idx, ..., 0], 0, -1)  # (..., wavelengths, z)
+	B = np.moveaxis(amplitudes[idx, ..., 1], 0, -1)
+	with np.errstate(over='ignore', invalid='ignore'):
+		forward = A * np.exp(1j*(k_z[idx] * from_left).T)
+		backward = np.where(B != 0, B * np.exp(-1j*(k_z[idx] * from_right).T), 0)  # B = 0 in the last layer
+
+	if wave_type == 'mixed':
+		intensity = np.stack((np.abs(forward[0] + backward[0])**2,
+							  p_wave_intensity(forward[1], backward[1], theta, layers, idx)))
+	elif wave_type == 'p-wave':
+		intensity = p_wave_intensity(forward, backward, theta, layers, idx)
+	else:
+		intensity = np.abs(forward + backward)**2
+	return intensity
+
+
+def p_wave_intensity(forward, backward, theta, layers, idx):
+	"""|E|^2 of p-waves from the tangential, cos(theta_j)*(A+B), and
+	   normal, sin(theta_j)*(A-B), components in the layer of each z point."""
+	n = refractive_indices(layers)
+	sin_theta = (n[0] * np.sin(theta) / n)[idx].T
+	cos_theta = np.sqrt(1 - sin_theta**2)
+	return np.abs(cos_theta * (forward + backward))**2 + np.abs(sin_theta * (forward - backward))**2
 
-	fig, ax = plt.subplots()
 
-	# Generate E-field profile
-	for idx, x_i in enumerate(x):
-		f = a[idx] * np.exp(1j * k * x_i)
-		profile.append(f)
-		ax.plot(x_i, f, label='{}'.format(layers[idx].material))
-
-	ax.legend()
-
-	ax.axvline(x=layer_coords[1])
-	ax.axvline(x=layer_coords[2])
-	ax.axvline(x=layer_coords[3])
-
-	field_output = ''
-	with pkg_resources.path('data', 'out/field_test.csv') as field:
-		field_output = field
-	with open (field_output, 'w') as out_file:
-		filewriter = csv.writer(out_file, delimiter=',')
-		header = ['x', 'field']
-		filewriter.writerow(header)
-		i = 0
-		while i < len(x):
-			row = [x[i], profile[i]]
-			filewriter.writerow(row)
-			i+=1
-	print("Wrote field output to {}".format(field_output))
+def output_field_profile(wavelengths, layers, z, intensity, wavelength, output_file=None):
+	"""
+	Plots |E(z)|^2 (from field_profile) at the simulated wavelength closest
+	to wavelength (um), with the interfaces marked and each layer labelled.
+	If output_file is given, z (nm) and |E|^2 are also written to csv.
+	"""
+	idx = int(np.argmin(np.abs(np.asarray(wavelengths) - wavelength)))
+	z_nm = np.asarray(z) * 10**9
+	boundaries = layer_boundaries(layers) * 10**9
+
+	fig, ax = plt.subplots()
+	ax.plot(z_nm, intensity[idx])
+	for x in boundaries:
+		ax.axvline(x=x, color='gray', linestyle='dashed')
+	for layer, left, right in zip(layers, [z_nm.min()] + list(boundaries), list(boundaries) + [z_nm.max()]):
+		ax.text((left + right) / 2, ax.get_ylim()[1], layer.material, ha='center', va='top')
+	ax.set_xlabel('z (nm)')
+	ax.set_ylabel(r'$|E|^2$')
+	ax.set_title('{:.4g} um'.format(wavelengths[idx]))
+
+	if output_file:
+		with open(output_file, 'w', encoding='utf8', newline='') as out_file:
+			filewriter = csv.writer(out_file, delimiter=',')
+			filewriter.writerow(['z (nm)', 'Field intensity'])
+			filewriter.writerows(zip(z_nm, intensity[idx]))
+		print("Wrote field output to {}".format(output_file))
 
 	plt.show()
 
@@ -505,59 +1162,697 @@ def transmission_matrix(r_ij, t_ij):
 # ========= ========= ========= ========= ========== ========= ======== #
 
 
-def perform_transfer_matrix(sim_path, angle, wavelengths, layers, wave_type):
+def share_device(wavelengths, layers):
+	"""
+	Copies the wavelength grid and the complex refractive index of every
+	layer into one shared memory block, so pool processes can use them
+	without each task pickling the layers.
+	Outputs: the SharedMemory block (close and unlink it when the pool is
+			 finished) and the initargs for attach_device.
+	"""
+	wavelengths = np.ascontiguousarray(wavelengths, dtype=float)
+	n = refractive_indices(layers).astype(complex)
+	shm = shared_memory.SharedMemory(create=True, size=wavelengths.nbytes + n.nbytes)
+	np.ndarray(wavelengths.shape, dtype=float, buffer=shm.buf)[:] = wavelengths
+	np.ndarray(n.shape, dtype=complex, buffer=shm.buf, offset=wavelengths.nbytes)[:] = n
+
+	return shm, (shm.name, len(wavelengths), layer_info(layers))
+
+
+def layer_info(layers):
+	"""Everything but the refractive index needed to rebuild layers (see device_layers)."""
+	return [(layer.material, layer.num_points, layer.thickness, layer.coherent) for layer in layers]
+
+
+def device_layers(n, info):
+	"""
+	Inputs: complex refractive index array with shape (number of layers,
+			number of wavelengths) and layer_info for the same layers.
+	Output: list of layers whose index arrays are views into n.
+	"""
+	layers = []
+	for idx, (material, num_points, thickness, coherent) in enumerate(info):
+		layer = Layer(material, num_points, thickness=thickness)
+		layer.coherent = coherent
+		layer.complex_refractive = n[idx]
+		layers.append(layer)
+	return layers
+
+
+def attach_device(shm_name, num_points, layer_info):
+	"""
+	Pool initializer. Attaches to the block made by share_device and builds
+	the layers with refractive index arrays that are views into it, so every
+	process reads the same memory instead of holding its own copy.
+	"""
+	shm = shared_memory.SharedMemory(name=shm_name)
+	wavelengths = np.ndarray((num_points,), dtype=float, buffer=shm.buf)
+	n = np.ndarray((len(layer_info), num_points), dtype=complex, buffer=shm.buf, offset=wavelengths.nbytes)
+	worker_device.update(shm=shm, wavelengths=wavelengths, layers=device_layers(n, layer_info))
+
+
+def grid_block(angles, wavelengths, layers, wave_type, engine='transfer'):
+	"""
+	Spectra for one block of the grid: angles (degrees) by wavelengths, with
+	layers restricted to those wavelengths. Same layout as transfer_matrix_grid.
+	"""
+	theta = np.asarray(angles, dtype=float)[:, np.newaxis] * np.pi / 180.0
+	return calculate_spectra(wavelengths, theta, layers, wave_type, engine)
+
+
+def shared_block(angles, wl_slice, wave_type, engine='transfer'):
+	"""grid_block for the device attached with attach_device."""
+	wavelengths = worker_device['wavelengths'][wl_slice]
+	layers = [layer[wl_slice] for layer in worker_device['layers']]
+	return grid_block(angles, wavelengths, layers, wave_type, engine)
+
+
+def parse_address(address):
+	"""'host:port' as the (host, port) tuple used by multiprocessing.connection."""
+	host, port = address.rsplit(':', 1)
+	return host, int(port)
+
+
+def coordinator_authkey(authkey=None):
+	"""
+	Key workers must present to the coordinator. Messages between them are
+	pickled, so every run needs a secret: authkey, PISTACHIO_AUTHKEY or,
+	when neither is set, a new random key for this run. The random key is
+	saved in AUTHKEY_FILE, readable only by this user, where workers of the
+	same user on this machine (or sharing the home directory) find it.
+	Outputs: the key as bytes and the key file written, or None.
+	"""
+	authkey = authkey or REMOTE_AUTHKEY
+	if authkey is not None:
+		return (authkey.encode() if isinstance(authkey, str) else authkey), None
+
+	authkey = secrets.token_hex(32)
+	os.makedirs(os.path.dirname(AUTHKEY_FILE), mode=0o700, exist_ok=True)
+	tmp_path = AUTHKEY_FILE + '.{}.tmp'.format(os.getpid())
+	with os.fdopen(os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600), 'w') as f:
+		f.write(authkey)
+	os.replace(tmp_path, AUTHKEY_FILE)
+	return authkey.encode(), AUTHKEY_FILE
+
+
+def worker_authkey(authkey=None):
+	"""
+	Key a worker presents to the coordinator: authkey, PISTACHIO_AUTHKEY or
+	the key saved in AUTHKEY_FILE by a coordinator (see coordinator_authkey).
+	Raises ValueError if there is no key.
+	"""
+	authkey = authkey or REMOTE_AUTHKEY
+	if authkey is None:
+		try:
+			with open(AUTHKEY_FILE, 'r') as f:
+				authkey = f.read().strip()
+		except FileNotFoundError:
+			raise ValueError("No key in {}. Start the coordinator first or set the PISTACHIO_AUTHKEY "
+							 "environment variable.".format(AUTHKEY_FILE)) from None
+	return authkey.encode() if isinstance(authkey, str) else authkey
+
+
+def coordinate_blocks(chunks, angles, wavelengths, layers, wave_type, writer, engine='transfer',
+					  address=REMOTE_ADDRESS, authkey=None, idle_timeout=REMOTE_IDLE_TIMEOUT, block_timeout=None):
+	"""
+	Coordinator for the 'remote' scheduler. Listens on address (host:port)
+	for workers started with run_worker, which may be on other machines.
+	Connections need the key from coordinator_authkey. Each worker is sent
+	the wavelengths and refractive index data once, then one block of the
+	grid at a time; the spectra it sends back are handed to writer. A block
+	held by a worker that disconnects, or that has not answered within
+	block_timeout seconds (default REMOTE_BLOCK_TIMEOUT), is given to the
+	next free worker and the connection is dropped. Returns when every
+	block has been written, and raises RuntimeError if no worker is
+	connected for idle_timeout seconds.
+	"""
+	host, port = parse_address(address)
+	block_timeout = block_timeout or REMOTE_BLOCK_TIMEOUT
+	authkey, key_file = coordinator_authkey(authkey)
+	device = ('device', np.asarray(wavelengths, dtype=float), refractive_indices(layers).astype(complex),
+			  layer_info(layers), wave_type, engine)
+	pending = queue.Queue()
+	for idx in range(len(chunks)):
+		pending.put(idx)
+	remaining = [len(chunks)]
+	live = [0]  # Connected workers
+	lock = threading.Lock()
+	finished = threading.Event()
+
+	def serve(conn):
+		with lock:
+			live[0] += 1
+		try:
+			conn.send(device)
+			while not finished.is_set():
+				try:
+					idx = pending.get(timeout=0.5)
+				except queue.Empty:
+					continue
+				a_slice, wl_slice = chunks[idx]
+				try:
+					conn.send(('block', angles[a_slice], wl_slice))
+					if not conn.poll(block_timeout):
+						print("A worker did not return a block in {} seconds, giving it to another worker".format(block_timeout))
+						pending.put(idx)
+						return
+					message = conn.recv()
+				except (EOFError, OSError):
+					pending.put(idx)  # Worker left, give the block to another one
+					return
+				writer.reserve()
+				if message[0] == 'error':
+					writer.fail(RuntimeError("Remote worker failed: {}".format(message[1])))
+					finished.set()
+					break
+				writer.put(a_slice, wl_slice, message[1])
+				with lock:
+					remaining[0] -= 1
+					if remaining[0] == 0:
+						finished.set()
+			conn.send(('done',))
+		except (EOFError, OSError):
+			pass
+		finally:
+			conn.close()
+			with lock:
+				live[0] -= 1
+
+	listener = Listener((host, port), authkey=authkey)
+	print("Waiting for workers on {}:{}".format(host, listener.address[1]))
+	if key_file is not None:
+		print("Workers read the key for this run from {}".format(key_file))
+
+	def accept():
+		while True:
+			try:
+				conn = listener.accept()
+			except (multiprocessing.AuthenticationError, OSError) as error:
+				if finished.is_set():
+					break
+				print("Rejected a worker connection: {}".format(error))
+				continue
+			if finished.is_set():
+				conn.close()
+				break
+			threading.Thread(target=serve, args=(conn,), daemon=True).start()
+
+	accept_thread = threading.Thread(target=accept, daemon=True)
+	accept_thread.start()
+	idle_since = time.time()
+	timed_out = False
+	while not finished.wait(0.5):
+		with lock:
+			if live[0] > 0:
+				idle_since = time.time()
+		if time.time() - idle_since > idle_timeout:
+			timed_out = True
+			finished.set()
+	if accept_thread.is_alive():
+		try:
+			Client(listener.address, authkey=authkey).close()  # Wake up the accept thread so it can exit
+		except OSError:
+			pass
+		accept_thread.join()
+	listener.close()
+	if key_file is not None:
+		try:
+			with open(key_file, 'r') as f:
+				if f.read().strip().encode() == authkey:
+					os.remove(key_file)  # Not replaced by a later coordinator
+		except OSError:
+			pass
+	if timed_out:
+		raise RuntimeError("No remote worker connected to {} for {} seconds.".format(address, idle_timeout))
+
+
+def run_worker(address=REMOTE_ADDRESS, authkey=None, timeout=WORKER_CONNECT_TIMEOUT):
+	"""
+	Worker for the 'remote' scheduler. Connects to the coordinator at address
+	(host:port) with the key from worker_authkey, retrying for up to timeout
+	seconds, and computes the blocks it is sent with grid_block until the
+	coordinator is finished.
+	Output: number of blocks computed.
+	"""
+	host_port = parse_address(address)
+	start = time.time()
+	while True:
+		try:
+			conn = Client(host_port, authkey=worker_authkey(authkey))
+			break
+		except (ConnectionRefusedError, multiprocessing.AuthenticationError, ValueError):
+			# Coordinator not started yet, or its key file is left from an earlier run
+			if time.time() - start > timeout:
+				raise
+			time.sleep(0.5)
+
+	_, wavelengths, n, info, wave_type, engine = conn.recv()
+	layers = device_layers(n, info)
+	num_blocks = 0
+	while True:
+		try:
+			message = conn.recv()
+		except EOFError:
+			break
+		if message[0] == 'done':
+			break
+		_, angles, wl_slice = message
+		try:
+			spectra = grid_block(angles, wavelengths[wl_slice], [layer[wl_slice] for layer in layers], wave_type, engine)
+		except Exception as error:
+			conn.send(('error', repr(error)))
+			break
+		conn.send(('result', spectra))
+		num_blocks += 1
+	conn.close()
+	return num_blocks
+
+
+def grid_chunks(num_angles, num_wavelengths, num_layers, max_memory=MAX_MEMORY, num_polarizations=1, min_chunks=1):
+	"""
+	Split an (angle, wavelength) grid into blocks small enough that the matrix
+	stacks for one block fit in max_memory megabytes. The grid is split into
+	at least min_chunks blocks (when it has that many points) of nearly equal
+	size, so blocks can be balanced across workers.
+	Output: list of (angle slice, wavelength slice) tuples covering the grid.
+	"""
+	matrix_bytes = 4 * np.dtype(complex).itemsize * num_polarizations
+	point_bytes = matrix_bytes * (3*num_layers + 2)  # matrix list plus product temporaries
+	max_points = max(1, int(max_memory * 2**20 // point_bytes))
+	max_points = min(max_points, max(1, -(-num_angles*num_wavelengths // min_chunks)))
+
+	if max_points >= num_wavelengths:
+		num_wl_chunks = 1
+		num_angle_chunks = -(-num_angles // (max_points // num_wavelengths))
+	else:
+		num_wl_chunks = -(-num_wavelengths // max_points)
+		num_angle_chunks = num_angles
+
+	# Block edges spread as evenly as possible
+	angle_edges = [i*num_angles // num_angle_chunks for i in range(num_angle_chunks + 1)]
+	wl_edges = [i*num_wavelengths // num_wl_chunks for i in range(num_wl_chunks + 1)]
+	chunks = []
+	for a, a_end in zip(angle_edges, angle_edges[1:]):
+		for w, w_end in zip(wl_edges, wl_edges[1:]):
+			chunks.append((slice(a, a_end), slice(w, w_end)))
+	return chunks
+
+
+def missing_chunks(mask, num_layers, max_memory=MAX_MEMORY, num_polarizations=1, min_chunks=1):
+	"""
+	Blocks covering only the (angle, wavelength) points that are False in
+	mask, for extending an existing result. Consecutive angles missing the
+	same wavelengths are grouped into rectangles, each split by grid_chunks.
+	Output: list of (angle slice, wavelength slice) tuples.
+	"""
+	rectangles = []
+	a = 0
+	while a < mask.shape[0]:
+		missing = ~mask[a]
+		a_end = a + 1
+		while a_end < mask.shape[0] and np.array_equal(~mask[a_end], missing):
+			a_end += 1
+		edges = np.flatnonzero(np.diff(np.concatenate(([0], missing.astype(np.int8), [0]))))
+		for w, w_end in zip(edges[::2], edges[1::2]):
+			rectangles.append((a, a_end, w, w_end))
+		a = a_end
+
+	chunks = []
+	total = max(1, np.count_nonzero(~mask))
+	for a, a_end, w, w_end in rectangles:
+		size = (a_end - a) * (w_end - w)
+		sub_chunks = max(1, round(min_chunks * size / total))
+		for a_slice, wl_slice in grid_chunks(a_end - a, w_end - w, num_layers, max_memory, num_polarizations, sub_chunks):
+			chunks.append((slice(a + a_slice.start, a + a_slice.stop), slice(w + wl_slice.start, w + wl_slice.stop)))
+	return chunks
+
+
+def transfer_matrix_grid(angles, wavelengths, layers, wave_type, max_memory=MAX_MEMORY, engine='transfer', writer=None):
+	"""
+	Inputs: angles (degrees), wavelengths (um), layers with interpolated
+			refractive index data, polarization, a memory budget in MB,
+			the engine ('transfer' or 'scattering', see calculate_spectra)
+			and an optional results.ResultWriter that is handed each block
+			as soon as it is computed.
+	Outputs: transmittance, reflectance and absorbance as 2-D arrays with
+			 shape (number of angles, number of wavelengths). For mixed
+			 waves the arrays have a leading polarization axis ordered as
+			 in POLARIZATIONS.
+
+	The whole grid is evaluated as (angles, wavelengths, 2, 2) matrix stacks,
+	one block at a time so the memory used stays under max_memory.
+	"""
+	angles = np.asarray(angles, dtype=float)
+	wavelengths = np.asarray(wavelengths)
+	grid_shape = (len(angles), len(wavelengths))
+	shape = grid_shape
+	num_pol = 1
+	if wave_type == 'mixed':
+		num_pol = len(POLARIZATIONS)
+		shape = (num_pol,) + grid_shape
+	transmittance = np.empty(shape)
+	reflectance = np.empty(shape)
+
+	for a_slice, wl_slice in grid_chunks(*grid_shape, len(layers), max_memory, num_pol):
+		theta = angles[a_slice, np.newaxis] * np.pi / 180.0
+		wl_layers = layers
+		if len(wavelengths[wl_slice]) < len(wavelengths):
+			wl_layers = [layer[wl_slice] for layer in layers]
+		T, R, A = calculate_spectra(wavelengths[wl_slice], theta, wl_layers, wave_type, engine)
+		transmittance[..., a_slice, wl_slice] = T
+		reflectance[..., a_slice, wl_slice] = R
+		if writer is not None:
+			writer.reserve()
+			writer.put(a_slice, wl_slice, (T, R, 1 - T - R))
+
+	absorbance = 1 - transmittance - reflectance
+	return transmittance, reflectance, absorbance
+
+
+def scheduled_grid(angles, wavelengths, layers, wave_type, writer, workers=None, scheduler='process',
+				   max_memory=MAX_MEMORY, engine='transfer', address=REMOTE_ADDRESS, mask=None):
+	"""
+	Computes the (angle, wavelength) grid in blocks spread over workers and
+	hands each block to writer (a results.ResultWriter) as it finishes.
+
+	Blocks are sized by grid_chunks to fit in CHUNK_MEMORY (or max_memory if
+	smaller), with at least CHUNKS_PER_WORKER blocks per worker, so a run with
+	one angle and many wavelengths still uses every core.
+	scheduler is one of SCHEDULERS:
+		'process': a process pool reading the device from shared memory
+		'thread': a thread pool sharing the layers directly; the numpy
+				  kernels release the GIL for large blocks
+		'serial': every block in this process
+		'remote': workers that connect to address over a socket, on this
+				  or other machines (see coordinate_blocks and run_worker)
+	workers defaults to the number of CPU cores. For 'remote' it is the
+	number of workers expected, which only sets how the grid is split.
+	If mask is given, only the points where it is False are computed.
+	Other schedulers raise ValueError.
+	"""
+	if scheduler not in SCHEDULERS:
+		raise ValueError("Unknown scheduler '{}'. Choose one of {}.".format(scheduler, SCHEDULERS))
+	workers = workers or multiprocessing.cpu_count()
+	angles = np.asarray(angles, dtype=float)
+	wavelengths = np.asarray(wavelengths)
+	num_pol = len(POLARIZATIONS) if wave_type == 'mixed' else 1
+	min_chunks = 1 if scheduler == 'serial' else workers * CHUNKS_PER_WORKER
+	if mask is None:
+		chunks = grid_chunks(len(angles), len(wavelengths), len(layers), min(max_memory, CHUNK_MEMORY),
+							 num_pol, min_chunks)
+	else:
+		chunks = missing_chunks(mask, len(layers), min(max_memory, CHUNK_MEMORY), num_pol, min_chunks)
+
+	if scheduler == 'serial':
+		for a_slice, wl_slice in chunks:
+			spectra = grid_block(angles[a_slice], wavelengths[wl_slice], [layer[wl_slice] for layer in layers],
+								 wave_type, engine)
+			writer.reserve()
+			writer.put(a_slice, wl_slice, spectra)
+		return
+	elif scheduler == 'remote':
+		coordinate_blocks(chunks, angles, wavelengths, layers, wave_type, writer, engine, address)
+		return
+
+	shm = None
+	try:
+		if scheduler == 'process':
+			shm, shared_args = share_device(wavelengths, layers)
+			pool = multiprocessing.Pool(workers, initializer=attach_device, initargs=shared_args)
+		else:
+			pool = multiprocessing.pool.ThreadPool(workers)
+
+		try:
+			for a_slice, wl_slice in chunks:
+				if scheduler == 'process':
+					task, args = shared_block, (angles[a_slice], wl_slice, wave_type, engine)
+				else:
+					task, args = grid_block, (angles[a_slice], wavelengths[wl_slice],
+											  [layer[wl_slice] for layer in layers], wave_type, engine)
+				writer.reserve()
+				pool.apply_async(task, args=args, callback=functools.partial(writer.put, a_slice, wl_slice),
+								 error_callback=writer.fail)
+			pool.close()
+			pool.join()
+		except BaseException:
+			pool.terminate()  # Interrupted; stop the workers before the shared block goes away
+			raise
+	finally:
+		if shm is not None:
+			shm.close()
+			shm.unlink()
+
+
+def simulate_field(device, z, angle=None, wave_type='s-wave'):
+	"""
+	Field intensity map of a device (yaml path or dictionary, see simulate).
+	Inputs: positions z (m, 0 at the first interface), incident angle in
+			degrees (default theta_i of the device) and polarization.
+	Outputs: wavelengths (um) and |E(z)|^2 with shape (number of
+			 wavelengths, number of z points), see field_profile.
+	"""
+	device, layers, angles, wavelengths = load_device(device)
+	if angle is None:
+		angle = angles[0]
+	theta = angle * np.pi / 180.0
+	return wavelengths, field_profile(wavelengths, theta, layers, z, wave_type)
+
+
+def angle_resolved_grid(result_file, angles, wavelengths, layers, wave_type, config=None, workers=None,
+						scheduler='process', max_memory=MAX_MEMORY, engine='transfer', address=REMOTE_ADDRESS,
+						family=None, search_paths=()):
+	"""
+	Computes the angle x wavelength grid with scheduled_grid, streaming the
+	blocks into a new result file as they finish.
+
+	Points already computed in any result file among search_paths with the
+	same family (see family_key) are copied instead of recomputed, so
+	widening the angle or wavelength range only computes the new region.
+	"""
+	write_path = result_file
+	if os.path.exists(result_file):
+		write_path = result_file + '.{}.tmp'.format(os.getpid())  # The old file may be merged from
+	store = results.ResultStore.create(write_path, angles, wavelengths, wave_type, config, family)
+	copied = results.merge_results(store, results.find_results(family, search_paths))
+	if copied:
+		print("Reusing {} of {} points from earlier results".format(copied, store.mask.size))
+
+	if copied < store.mask.size:
+		workers = workers or multiprocessing.cpu_count()
+		print("")
+		print("Workers: {} ({})".format(workers, scheduler))
+		pbar = tqdm(total=store.mask.size - copied, unit='points')
+		writer = results.ResultWriter(store, workers + results.WRITER_QUEUE_SIZE, pbar.update)
+		writer.start()
+		mask = np.array(store.mask) if copied else None
+		scheduled_grid(angles, wavelengths, layers, wave_type, writer, workers, scheduler, max_memory, engine,
+					   address, mask)
+		writer.close()
+		pbar.close()
+	store.flush()
+	if write_path != result_file:
+		os.replace(write_path, result_file)
+
+
+def sweep_folder(parameter, idx, value):
+	"""
+	Folder name for one value of a sweep. Numbers give the parameter and
+	value, e.g. thickness_10000.0. Other values (index file paths) give the
+	parameter, the sweep index and the file name without directories or
+	extension with unsafe characters replaced, e.g. refractive_filename_0_Au.
+	"""
+	if isinstance(value, (int, float, np.number)):
+		return '{}_{}'.format(parameter, value)
+	name = os.path.splitext(os.path.basename(os.path.normpath(str(value))))[0]
+	name = re.sub(r'[^\w.-]', '_', name).strip('.')
+	return '{}_{}_{}'.format(parameter, idx, name) if name else '{}_{}'.format(parameter, idx)
 
-	transmittance = []
-	reflectance = []
-	absorbance = []
 
-	for lmbda in wavelengths:
+def angle_resolved_sweep(sim_path, angles, wavelengths, layers, sweep, variants, wave_type, engine='transfer', config=None):
+	"""
+	Runs a parameter sweep (see get_sweep_from_yaml and sweep_spectra) for
+	every angle. Results for each value go in their own folder (see
+	sweep_folder), each with its own result file. Angles are computed one
+	after another in this process, without a scheduler or the result cache.
+	Output: list of the folders written.
+	"""
+	layer_num, parameter, values = sweep
+	value_paths = []
+	stores = []
+	for idx, value in enumerate(values):
+		path = os.path.join(sim_path, sweep_folder(parameter, idx, value))
+		os.makedirs(path, exist_ok=True)
+		value_paths.append(path)
+		stores.append(results.ResultStore.create(os.path.join(path, results.RESULT_FILE),
+												 angles, wavelengths, wave_type, dict(config or {}, sweep_value=value)))
+
+	for a_idx, angle in enumerate(tqdm(angles)):
 		theta = angle * np.pi / 180.0
-		M = build_matrix_list(lmbda, theta, layers, wave_type)
-		TM = np.linalg.multi_dot(M)
-		T = find_transmittance(TM).real
-		R = find_reflectance(TM).real
+		spectra = sweep_spectra(wavelengths, theta, layers, layer_num, variants, wave_type, engine)
+		for idx, store in enumerate(stores):
+			store.write(a_idx, slice(None), *[s[idx] for s in spectra])
+	for store in stores:
+		store.flush()
+	return value_paths
+
+
+def load_device(device):
+	"""
+	Input: path to a device yaml file or the device dictionary itself.
+	Output: device dictionary, list of layers with index data resampled onto
+			the simulation wavelengths, angles (degrees) and wavelengths (um).
+	"""
+	if not isinstance(device, dict):
+		device = get_dict_from_yaml(device)  # yaml config file stored as dictionary
+	layers = get_layers_from_yaml(device) 	 # a list of layer objects
+	field_amp = device['wave']      		 # Electric field amplitude
+	theta_i = field_amp['theta_i']  		 # Initial incident wave angle
+	theta_f = field_amp['theta_f'] 			 # Final incident wave angle
+	num_angles = field_amp['num_angles']  	 # Number of angles to sweep through
+	angles = np.linspace(theta_i, theta_f, num_angles)
+
+	# Initialize Wave class
+	wave = Wave(float(device['min_wavelength']), float(device['max_wavelength']), int(device['num_points']))
+	wave.make_wavelengths()  # still in units of um
 
-		transmittance.append(T)
-		reflectance.append(R)
-		absorbance.append(1 - T - R)
+	# Interpolating downloaded index data so number of data points match.
+	interpolation = device.get('interpolation', 'linear')
+	for layer in layers:
+		layer.make_new_data_points(wave.wavelengths, interpolation)
+	return device, layers, angles, wave.wavelengths
+
+
+def device_key(device, layers, wave_type):
+	"""
+	Content hash identifying the spectra of a simulation: the device
+	dictionary (layers, wavelengths, angles, engine, ...) in canonical form,
+	the polarization and the contents of every refractive index file used.
+	Renaming or touching a file keeps the key; editing its data changes it.
+	"""
+	digest = hashlib.sha1()
+	digest.update(json.dumps(device, sort_keys=True, default=str).encode('utf8'))
+	digest.update(wave_type.encode('utf8'))
+	digest.update(str(CACHE_VERSION).encode('utf8'))
+	for layer in layers:
+		if layer.source is not None:
+			digest.update(file_digest(layer.source[0]).encode('utf8'))
+	return digest.hexdigest()
+
+
+def family_key(device, layers, wave_type):
+	"""
+	device_key without the wavelength and angle grid settings. Results with
+	the same family key differ only in which points were computed, so an
+	earlier result can fill in part of a new grid (see results.merge_results).
+	"""
+	device = {key: value for key, value in device.items() if key not in GRID_KEYS}
+	device['wave'] = {key: value for key, value in device.get('wave', {}).items() if key not in WAVE_GRID_KEYS}
+	return device_key(device, layers, wave_type)
+
+
+def simulate(device, wave_type='mixed', max_memory=MAX_MEMORY, output_dir=None, cache_dir=None, reuse=False):
+	"""
+	Python interface to the angle-resolved simulation.
+	Inputs: device yaml path or dictionary (same format as the yaml files),
+			polarization, memory budget in MB (see transfer_matrix_grid), an
+			optional directory to also write one csv file per angle, an
+			optional result cache directory (e.g. results.RESULT_CACHE) and
+			whether to reuse points from cached results of the same device.
+	Output: SimulationResult holding transmittance, reflectance and
+			absorptance arrays on the (angle, wavelength) grid.
+
+	With cache_dir, results are cached under device_key, so running an
+	unchanged device again loads the spectra from the cache instead of
+	recomputing them. Otherwise the grid is computed in memory. If the
+	cache directory cannot be written the result is not cached. With
+	reuse, points already in a cached result of the same device with a
+	different grid are copied and only the new ones are computed.
+	"""
+	device, layers, angles, wavelengths = load_device(device)
+	engine = device.get('engine', 'transfer')
+	key = device_key(device, layers, wave_type)
+	cached = results.cached_result(key, cache_dir) if cache_dir else None
+	result = results.load_result(cached) if cached else None
+	if result is None and cache_dir and reuse:
+		# Points already in a cached result of the same device are reused
+		tmp_path = os.path.join(cache_dir, '{}.{}.tmp'.format(key, os.getpid()))
+		search_paths = glob.glob(os.path.join(cache_dir, '*' + os.path.splitext(results.RESULT_FILE)[1]))
+		try:
+			os.makedirs(cache_dir, exist_ok=True)
+			angle_resolved_grid(tmp_path, angles, wavelengths, layers, wave_type, device, 1, 'serial', max_memory,
+								engine, family=family_key(device, layers, wave_type), search_paths=search_paths)
+		except OSError:
+			if os.path.exists(tmp_path):
+				os.remove(tmp_path)  # Read-only or full cache directory; compute in memory below
+		else:
+			result = results.load_result(results.cache_result(tmp_path, key, cache_dir, move=True) or tmp_path)
+	if result is None:
+		spectra = transfer_matrix_grid(angles, wavelengths, layers, wave_type, max_memory, engine)
+		result = results.SimulationResult(angles, wavelengths, *spectra, wave_type, config=device)
+		if cache_dir:
+			results.cache_result(result, key, cache_dir, family=family_key(device, layers, wave_type))
+	if output_dir is not None:
+		result.write_csv(output_dir)
+	return result
+
+
+def simulate_sweep(device, wave_type='mixed'):
+	"""
+	Same as simulate for a device with a sweep section (see get_sweep_from_yaml).
+	Output: list with one SimulationResult for each swept value. The value is
+			stored under 'sweep_value' in each result's config.
+	"""
+	device, layers, angles, wavelengths = load_device(device)
+	engine = device.get('engine', 'transfer')
+	layer_num, parameter, values = sweep = get_sweep_from_yaml(device)
+	variants = make_sweep_layers(device, *sweep, wavelengths, device.get('interpolation', 'linear'))
+
+	shape = (len(values), len(angles), len(wavelengths))
+	if wave_type == 'mixed':
+		shape = (len(values), len(POLARIZATIONS), len(angles), len(wavelengths))
+	spectra = [np.empty(shape) for _ in range(3)]
+	for idx, angle in enumerate(angles):
+		theta = angle * np.pi / 180.0
+		for s, s_angle in zip(spectra, sweep_spectra(wavelengths, theta, layers, layer_num, variants, wave_type, engine)):
+			s[..., idx, :] = s_angle
 
-	#Write everything to a csv file
-	row = [wavelengths, transmittance, reflectance, absorbance]
-	write_tmm_results(angle, sim_path, row)
-# 	results = [wavelengths, transmittance, reflectance, absorbance]
-# 	return angle, sim_path, results
+	sweep_results = []
+	for v_idx, value in enumerate(values):
+		config = dict(device, sweep_value=value)
+		sweep_results.append(results.SimulationResult(angles, wavelengths, *[s[v_idx] for s in spectra], wave_type, config))
+	return sweep_results
 
 
-def angle_resolved_multiprocess(device_yaml, output_dir, wave_type):
+def angle_resolved_multiprocess(device_yaml, output_dir, wave_type, grid=False, max_memory=MAX_MEMORY, csv_output=False,
+								workers=None, scheduler='process', address=REMOTE_ADDRESS, cache_dir=results.RESULT_CACHE):
 	"""
 	Inputs: yaml file containing information about device and incident radiation.
 	Outputs: Executes transfer matrix and other functions
 	   		 Writes output file.
 	   		 
-	This process uses the Python multiprocessing library. Each angle is assigned
-	its own process to speed up transfer matrix calculations for angle-tuned
-	simulations.
+	The angle x wavelength grid is split into blocks that are computed by a
+	pool of workers (see scheduled_grid). By default this is a process pool
+	with one process per CPU core. If grid is True, every block is computed
+	in this process (the 'serial' scheduler).
+	Devices with a sweep section are run with angle_resolved_sweep.
+
+	Spectra are saved in a single result file (see results.ResultStore). If
+	csv_output is True, one csv file per angle is also exported next to it.
+	Results are cached in cache_dir (None to disable, see device_key); an
+	unchanged device is linked from the cache instead of being recomputed.
+	If only the angles or wavelengths changed, points found in the cache or
+	in other simulation folders of output_dir are reused and only the rest
+	of the grid is computed. Sweeps are not cached.
 	"""
 	# Inputs
-	device = get_dict_from_yaml(device_yaml)  # yaml config file stored as dictionary
-	layers = get_layers_from_yaml(device) 	  # a list of layer objects
-	field_amp = device['wave']      		  # Electric field amplitude
-	theta_i = field_amp['theta_i']  		  # Initial incident wave angle
-	theta_f = field_amp['theta_f'] 			  # Final incident wave angle
-	num_angles = field_amp['num_angles']  	  # Number of angles to sweep through
-	angles = np.linspace(theta_i, theta_f, num_angles)
-	
-	# Initialize Wave class	
+	device, layers, angles, wavelengths = load_device(device_yaml)
+	engine = device.get('engine', 'transfer')  # Transfer matrix or scattering matrix
+	interpolation = device.get('interpolation', 'linear')
+	sweep = get_sweep_from_yaml(device)  	  # Optional parameter sweep of one layer
+	theta_i = device['wave']['theta_i']
+	theta_f = device['wave']['theta_f']
 	min_wavelength = float(device['min_wavelength'])
 	max_wavelength = float(device['max_wavelength'])
-	num_points = int(device['num_points'])
-	wave = Wave(min_wavelength, max_wavelength, num_points)
-	wave.make_wavelengths()  # still in units of um
-
-	# Interpolating downloaded index data so number of data points match.
-	for layer in layers:
-		layer.make_new_data_points(wave.wavelengths)
 
 	# Make folder for simulation results
 	device_name = device_yaml.split('/')[-1]  # Get filename without path or '.yaml'
@@ -567,21 +1862,35 @@ def angle_resolved_multiprocess(device_yaml, output_dir, wave_type):
 	if not os.path.exists(sim_path):
 		os.makedirs(sim_path)
 
-	print("")
-	num_cores = multiprocessing.cpu_count()
-	print("CPU Core Count:", num_cores)
-	pool = multiprocessing.Pool(num_cores)
-	
-	n = len(angles)
-	pbar = tqdm(total=n)
-	
-	res = [pool.apply_async(perform_transfer_matrix, 
-							args=(sim_path, angle, wave.wavelengths, layers, wave_type),
-							callback = lambda _: pbar.update(1)) for angle in angles]
-	results = [p.get() for p in res]
-	pool.close()
-	pool.join()
-	pbar.close()
+	result_paths = [sim_path]
+	if sweep:
+		variants = make_sweep_layers(device, *sweep, wavelengths, interpolation)
+		result_paths = angle_resolved_sweep(sim_path, angles, wavelengths, layers, sweep, variants, wave_type, engine, device)
+	else:
+		key = device_key(device, layers, wave_type)
+		result_file = os.path.join(sim_path, results.RESULT_FILE)
+		cached = results.cached_result(key, cache_dir) if cache_dir else None
+		if cached:
+			print("Unchanged device, using cached result {}".format(cached))
+			if not (os.path.exists(result_file) and os.path.samefile(cached, result_file)):
+				# Renaming a link onto another link of the same file would leave the new link behind
+				tmp_path = result_file + '.{}.tmp'.format(os.getpid())
+				results.link_file(cached, tmp_path)
+				os.replace(tmp_path, result_file)
+		else:
+			search_paths = []
+			if cache_dir:
+				search_paths = (glob.glob(os.path.join(output_dir, '*', results.RESULT_FILE)) +
+								glob.glob(os.path.join(cache_dir, '*' + os.path.splitext(results.RESULT_FILE)[1])))
+			angle_resolved_grid(result_file, angles, wavelengths, layers, wave_type, device, workers,
+								scheduler if not grid else 'serial', max_memory, engine, address,
+								family_key(device, layers, wave_type), search_paths)
+			if cache_dir:
+				results.cache_result(result_file, key, cache_dir)
+
+	if csv_output:
+		for path in result_paths:
+			results.export_csv(path, path)
 	print("")
 	print("Wrote results to {}".format(sim_path))
 
@@ -608,14 +1917,32 @@ def parse_arguments():
 	device_help = "Path for a yaml file from config_files describing a device."
 	output_help = "Directory for transfer matrix results."
 	pwave_help = "Boolean. Incident wave is p-wave."
-	swave_help = "Boolean. Incident s-wave."
+	swave_help = "Boolean. Incident s-wave. Without -p or -s, s-wave, p-wave and unpolarized spectra are all computed."
 	units_help = "Choose the units for the output electric field. Default is micrometers."
+	grid_help = "Compute every block of the angle x wavelength grid in this process (same as --scheduler serial)."
+	workers_help = "Number of worker processes or threads. Default is the number of CPU cores."
+	scheduler_help = "How blocks of the grid are spread over workers: {}. Default is process.".format(', '.join(SCHEDULERS))
+	address_help = "host:port the coordinator listens on for the remote scheduler and remote workers connect to. Default is {}.".format(REMOTE_ADDRESS)
+	worker_help = "Run as a remote worker for the coordinator at --address instead of running a simulation."
+	cache_dir_help = "Folder for the result cache. Default is {} (set PISTACHIO_CACHE to move the whole cache folder).".format(results.RESULT_CACHE)
+	no_cache_help = "Always recompute every point, without using the result cache or earlier results."
+	memory_help = "Memory budget in MB for each block of a grid calculation. Default is {}.".format(MAX_MEMORY)
+	csv_help = "Also write one csv file per angle next to the binary result file."
 
 	parser.add_argument('--debug', action='store_true', help="Enable debugging.")
-	parser.add_argument("device", help=device_help)
-	parser.add_argument("output", help=output_help)
+	parser.add_argument("device", help=device_help, nargs='?')
+	parser.add_argument("output", help=output_help, nargs='?')
 	parser.add_argument('-p', '--pwave', help=pwave_help, action='store_true')
 	parser.add_argument('-s', '--swave', help=swave_help, action='store_true')
+	parser.add_argument('-g', '--grid', help=grid_help, action='store_true')
+	parser.add_argument('--memory', help=memory_help, type=float, default=MAX_MEMORY)
+	parser.add_argument('--csv', help=csv_help, action='store_true')
+	parser.add_argument('--workers', help=workers_help, type=int, default=None)
+	parser.add_argument('--scheduler', help=scheduler_help, choices=SCHEDULERS, default='process')
+	parser.add_argument('--address', help=address_help, default=REMOTE_ADDRESS)
+	parser.add_argument('--worker', help=worker_help, action='store_true')
+	parser.add_argument('--cache-dir', help=cache_dir_help, default=results.RESULT_CACHE)
+	parser.add_argument('--no-cache', help=no_cache_help, action='store_true')
 
 	return parser.parse_args()
 
@@ -623,6 +1950,19 @@ def parse_arguments():
 def main(args):
 
 	logger.debug("Debugging enabled")
+	if args.worker:
+		logger.info("Worker for coordinator at {}".format(args.address))
+		try:
+			num_blocks = run_worker(args.address)
+		except ValueError as error:
+			print("ERROR: {}".format(error))
+			sys.exit()
+		logger.info("Computed {} blocks".format(num_blocks))
+		return
+	elif args.device is None or args.output is None:
+		print("ERROR: device and output are required unless running with --worker.")
+		sys.exit()
+
 	logger.info("Start simulation")
 	logger.info("Loading device parameters from {}".format(args.device))
 
@@ -634,10 +1974,15 @@ def main(args):
 		wave_type = 's-wave'
 		logger.info("Incident wave is s-wave.")
 	else:
-		logger.info("Incident wave is mixed.")
+		logger.info("Incident wave is mixed. Writing s-wave, p-wave and unpolarized spectra.")
 
 	start_time = time.time()
-	angle_resolved_multiprocess(args.device, args.output, wave_type)
+	try:
+		angle_resolved_multiprocess(args.device, args.output, wave_type, args.grid, args.memory, args.csv,
+									args.workers, args.scheduler, args.address, None if args.no_cache else args.cache_dir)
+	except ValueError as error:
+		print("ERROR: {}".format(error))
+		sys.exit()
 	end_time = time.time()
 	elapsed_time = np.round(end_time - start_time, 4)
 	logger.info('Elapsed time: {} seconds'.format(elapsed_time))